@@ -0,0 +1,412 @@
+#!/usr/bin/env python3
+"""
+Timing of the parsers over the sentences that ship with the repository.
+
+Usage: python3 benchmark.py [bench_name ...]
+       python3 benchmark.py suite results.json [baseline.json]
+       python3 benchmark.py compare baseline.json results.json
+       python3 benchmark.py against revision [bench_name ...]
+
+The last one runs the benchmarks on the tree at an earlier git revision
+(e.g. the one before a change to the parser), and then on this one.
+"""
+import json
+import os
+import signal
+import sys
+import time
+from collections import OrderedDict
+from itertools import islice
+
+import parser
+from instrumentation import Statistics
+
+
+def sentences(path='evaluation.tex'):
+    """Flattens the sections of a sentence file into (label, sentence) pairs"""
+    sections = parser.read_sentences(os.path.join(os.path.dirname(__file__), path))
+    for section, entries in sections.items():
+        if isinstance(entries, OrderedDict):
+            yield from entries.items()
+        else:
+            for n, sentence in enumerate(entries, 1):
+                yield '{}.{}'.format(section or os.path.basename(path), n), sentence
+
+
+def measure(fn, repeat=5):
+    """Returns the best wall time of `repeat` calls of fn, and its last result"""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def bench_earley_hasl1(path='evaluation.tex'):
+    """Earley parser with the HASL/1 grammar"""
+    import spacy
+    from hasl1.grammar import hasl1_grammar
+
+    nlp = spacy.load('en_core_web_sm', disable=['parser', 'ner', 'textcat'])
+
+    def run(tokens):
+        try:
+            return len(parser.Parser(hasl1_grammar, 'sentences').parse(tokens))
+        except parser.ParseError:
+            return 0
+
+    total = 0.0
+    for label, sentence in sentences(path):
+        tokens = nlp(sentence)
+        elapsed, count = measure(lambda: run(tokens))
+        total += elapsed
+        print("  {:<8} {:8.2f} ms {:4d} parses  {}".format(label, elapsed * 1000, count, sentence[:60]))
+    print("  total    {:8.2f} ms".format(total * 1000))
+
+
+def bench_earley_hasl1_forest(path='evaluation.tex'):
+    """Earley parser with the HASL/1 grammar in forest mode, counting all and deriving the first parse"""
+    import spacy
+    from hasl1.grammar import hasl1_grammar
+
+    nlp = spacy.load('en_core_web_sm', disable=['parser', 'ner', 'textcat'])
+
+    def run(tokens):
+        earley = parser.Parser(hasl1_grammar, 'sentences', forest=True)
+        try:
+            earley.feed(tokens)
+        except parser.ParseError:
+            return 0, 0
+        return earley.count(), len(earley.derivations(1))
+
+    total = 0.0
+    for label, sentence in sentences(path):
+        tokens = nlp(sentence)
+        elapsed, (count, first) = measure(lambda: run(tokens))
+        total += elapsed
+        print("  {:<8} {:8.2f} ms {:4d} derivations {:d} derived  {}".format(label, elapsed * 1000, count, first, sentence[:60]))
+    print("  total    {:8.2f} ms".format(total * 1000))
+
+
+def bench_recognizer_hasl1(path='evaluation.tex'):
+    """Recognizer with the HASL/1 grammar, as used by Parser(precheck=True)"""
+    import spacy
+    from hasl1.grammar import hasl1_grammar
+
+    nlp = spacy.load('en_core_web_sm', disable=['parser', 'ner', 'textcat'])
+    earley = parser.Parser(hasl1_grammar, 'sentences')
+
+    total = 0.0
+    for label, sentence in sentences(path):
+        tokens = nlp(sentence)
+        elapsed, (accepted, position) = measure(lambda: earley.recognize(tokens))
+        total += elapsed
+        print("  {:<8} {:8.2f} ms {:<8} {:4d} read  {}".format(label, elapsed * 1000, 'accepted' if accepted else 'rejected', position, sentence[:60]))
+    print("  total    {:8.2f} ms".format(total * 1000))
+
+
+def bench_startup(repeat=5):
+    """Importing hasl1.grammar and constructing the grammars of grammar/, each in a fresh interpreter"""
+    import subprocess
+
+    scripts = OrderedDict([
+        ('import hasl1.grammar', ('', 'import hasl1.grammar')),
+        ('grammar construction', (
+            'from grammar.shared import specific, negation, conditional\nfrom grammar import recursive',
+            'conditional.grammar(anaphora=True) | negation.grammar(anaphora=True) | recursive.grammar(anaphora=True)')),
+    ])
+
+    for label, (setup, statement) in scripts.items():
+        script = '\n'.join([
+            'import time',
+            setup,
+            'start = time.perf_counter()',
+            statement,
+            'print(time.perf_counter() - start)'])
+        timings = [float(subprocess.check_output([sys.executable, '-c', script], cwd=os.path.dirname(os.path.abspath(__file__))))
+                   for _ in range(repeat)]
+        print("  {:<22} {:8.2f} ms".format(label, min(timings) * 1000))
+
+
+class Word(parser.Symbol):
+    def test(self, literal, position, state):
+        return literal != 'because'
+
+
+because_grammar = [
+    parser.Rule('argument', [parser.RuleRef('claim')]),
+    parser.Rule('argument', [parser.RuleRef('claim'), parser.Literal('because'), parser.RuleRef('argument')]),
+    parser.Rule('claim', [Word()]),
+    parser.Rule('claim', [parser.RuleRef('claim'), Word()]),
+]
+
+
+def because_chain(depth):
+    """claim0 because claim1 because ... claim{depth}"""
+    return ' because '.join('claim{}'.format(n) for n in range(depth + 1)).split(' ')
+
+
+def bench_earley_right_recursion(depths=(50, 100, 200, 400, 800)):
+    """Earley parser in forest mode on synthetic "a because b because c ..." chains, with and without Leo's shortcut"""
+    def run(tokens, **options):
+        earley = parser.Parser(because_grammar, 'argument', **options)
+        earley.feed(tokens)
+        return len(earley.table[-1])
+
+    print("  {:>5} {:>12} {:>12}".format('depth', 'forest', 'forest+leo'))
+    for depth in depths:
+        tokens = because_chain(depth)
+        timings = [measure(lambda: run(tokens, forest=True, leo=leo), repeat=3)[0] for leo in (False, True)]
+        print("  {:>5} {:>9.2f} ms {:>9.2f} ms".format(depth, *(timing * 1000 for timing in timings)))
+
+
+def bench_earley_chart_memory(depth=50):
+    """Bytes per item of the Earley chart for a because-chain, as traced by tracemalloc"""
+    import gc
+    import tracemalloc
+
+    for options in (dict(), dict(forest=True, leo=False), dict(forest=True)):
+        gc.collect()
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        earley = parser.Parser(because_grammar, 'argument', **options)
+        earley.feed(because_chain(depth))
+        earley.results = []  # Only the chart itself
+        gc.collect()
+        size = tracemalloc.get_traced_memory()[0] - before
+        tracemalloc.stop()
+        items = sum(len(column) for column in earley.table)
+        print("  {:<28} {:6d} items {:6.0f} bytes/item".format(repr(options), items, size / items))
+
+
+# Structured suite: every engine over every corpus, saved as JSON so runs can be compared
+
+CORPORA = ('evaluation.tex', 'sentences.txt', 'grammar/examples.txt')
+
+
+def engine_earley(grammar_name):
+    """Earley parser with one of the HASL/1 grammars; sizes are items and largest_column"""
+    import spacy
+    from hasl1 import grammar
+
+    nlp = spacy.load('en_core_web_sm', disable=['parser', 'ner', 'textcat'])
+    rules = getattr(grammar, grammar_name)
+
+    def run(tokens, statistics=None, limit=None):
+        try:
+            return len(parser.Parser(rules, 'sentences', limit=limit, statistics=statistics).parse(tokens))
+        except parser.ParseError:
+            return 0
+
+    return nlp, run
+
+
+def engine_hasl2(left_corner=False, **options):
+    """Recursive descent (sizes: depth) or left corner (sizes: chart, stack, paths) parser with the HASL/2 grammar"""
+    from hasl2.grammar import rules, tokenize
+    if left_corner:
+        from nlpg_lc import LCParser as Parser
+    else:
+        from hasl2.parser import Parser
+
+    markers = rules.markers()
+
+    def run(tokens, statistics=None, limit=None):
+        return sum(1 for _ in islice(Parser(rules, statistics=statistics, **options).parse('sentences', tokens), limit))
+
+    return lambda sentence: list(tokenize(markers, sentence)), run
+
+
+ENGINES = OrderedDict([
+    ('earley-hasl0', lambda: engine_earley('hasl0_grammar')),
+    ('earley-hasl1', lambda: engine_earley('hasl1_grammar')),
+    ('rd-hasl2', lambda: engine_hasl2()),
+    ('packrat-hasl2', lambda: engine_hasl2(packrat=True)),
+    ('lc-hasl2', lambda: engine_hasl2(left_corner=True)),
+])
+
+
+class Timeout(Exception):
+    pass
+
+
+def deadline(fn, seconds):
+    """Calls fn, raising Timeout when it takes longer than `seconds` (if not None)"""
+    if seconds is None:
+        return fn()
+
+    def expire(signum, frame):
+        raise Timeout()
+
+    previous = signal.signal(signal.SIGALRM, expire)
+    signal.setitimer(signal.ITIMER_REAL, seconds)
+    try:
+        return fn()
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous)
+
+
+def profile(run, tokens, repeat=5, limit=None, timeout=None):
+    """
+    Times run(tokens) and measures a separate, untimed run with Statistics for
+    the size of the chart or stack, and another one with tracemalloc for the
+    peak of memory allocated while parsing.
+    """
+    import gc
+    import tracemalloc
+
+    entry = OrderedDict()
+    try:
+        entry['time'], entry['parses'] = measure(lambda: deadline(lambda: run(tokens, limit=limit), timeout), repeat)
+
+        statistics = Statistics()
+        deadline(lambda: run(tokens, statistics=statistics, limit=limit), timeout)
+        # Generators that were cut off by the limit never record their size
+        entry['sizes'] = statistics.parses[-1] if statistics.parses else None
+
+        gc.collect()
+        tracemalloc.start()
+        try:
+            deadline(lambda: run(tokens, limit=limit), timeout)
+            entry['allocated'] = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    except Timeout:
+        entry['timeout'] = True
+    except Exception as error:
+        entry['error'] = '{}: {}'.format(type(error).__name__, error)
+    return entry
+
+
+def suite(engines=None, corpora=CORPORA, repeat=5, limit=None, timeout=10.0):
+    """
+    Runs each engine over each corpus. An engine that cannot be set up (e.g.
+    because spaCy is not installed) is recorded as skipped, so the results of
+    the other engines can still be compared.
+    """
+    results = OrderedDict([
+        ('created', time.strftime('%Y-%m-%dT%H:%M:%S')),
+        ('python', sys.version.split()[0]),
+        ('options', dict(repeat=repeat, limit=limit, timeout=timeout)),
+        ('engines', OrderedDict()),
+    ])
+
+    for name in engines or ENGINES:
+        print("{}:".format(name))
+        try:
+            prepare, run = ENGINES[name]()
+        except Exception as error:
+            print("  skipped: {}: {}".format(type(error).__name__, error))
+            results['engines'][name] = dict(skipped='{}: {}'.format(type(error).__name__, error))
+            continue
+
+        entries = results['engines'][name] = []
+        for corpus in corpora:
+            for label, sentence in sentences(corpus):
+                entry = OrderedDict([('corpus', corpus), ('label', label), ('sentence', sentence)])
+                entry.update(profile(run, prepare(sentence), repeat=repeat, limit=limit, timeout=timeout))
+                entries.append(entry)
+                print("  {:<24} {}  {}".format(label[:24], describe(entry), sentence[:50]))
+    return results
+
+
+def describe(entry):
+    if entry.get('timeout'):
+        return '     timeout              '
+    if 'error' in entry:
+        return '       error              '
+    return '{:8.2f} ms {:4d} parses'.format(entry['time'] * 1000, entry['parses'])
+
+
+def compare(baseline, results, threshold=0.2, noise=0.001):
+    """
+    Prints the sentences whose parse got slower by more than `threshold` (and
+    more than `noise` seconds), or whose number of parses changed, and returns
+    how many regressions there were.
+    """
+    regressions = 0
+    for name, entries in results['engines'].items():
+        before = baseline['engines'].get(name)
+        if not isinstance(before, list) or not isinstance(entries, list):
+            print("{}: not in both runs".format(name))
+            continue
+
+        before = {(entry['corpus'], entry['label']): entry for entry in before}
+        total = [0.0, 0.0]
+        for entry in entries:
+            old = before.get((entry['corpus'], entry['label']))
+            if old is None:
+                continue
+            problems = []
+            if entry.get('timeout') and not old.get('timeout'):
+                problems.append('timed out')
+            elif 'time' in entry and 'time' in old:
+                total[0] += old['time']
+                total[1] += entry['time']
+                if entry['time'] - old['time'] > max(old['time'] * threshold, noise):
+                    problems.append('{:.2f} ms -> {:.2f} ms'.format(old['time'] * 1000, entry['time'] * 1000))
+                if entry['parses'] != old['parses']:
+                    problems.append('{} -> {} parses'.format(old['parses'], entry['parses']))
+            if problems:
+                regressions += 1
+                print("  {} {:<24} {}".format(name, entry['label'][:24], ', '.join(problems)))
+        print("{}: {:.2f} ms -> {:.2f} ms in total".format(name, total[0] * 1000, total[1] * 1000))
+    return regressions
+
+
+def do_suite(path, baseline=None):
+    results = suite()
+    with open(path, 'w') as fh:
+        json.dump(results, fh, indent=2)
+    if baseline is not None:
+        do_compare(baseline, path)
+
+
+def do_compare(baseline, path):
+    with open(baseline) as fh:
+        baseline = json.load(fh)
+    with open(path) as fh:
+        results = json.load(fh)
+    if compare(baseline, results) > 0:
+        sys.exit(1)
+
+
+def do_against(revision, *names):
+    """Runs the benchmarks on the tree at the revision with this benchmark.py, and then on this tree"""
+    import io
+    import shutil
+    import subprocess
+    import tarfile
+    import tempfile
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    with tempfile.TemporaryDirectory() as tree:
+        archive = subprocess.run(['git', 'archive', revision], cwd=here, check=True, stdout=subprocess.PIPE).stdout
+        with tarfile.open(fileobj=io.BytesIO(archive)) as tar:
+            tar.extractall(tree)
+        shutil.copy(os.path.join(here, 'benchmark.py'), tree)
+        if not os.path.exists(os.path.join(tree, 'instrumentation.py')):
+            shutil.copy(os.path.join(here, 'instrumentation.py'), tree)
+        for label, directory in ((revision, tree), ('this tree', here)):
+            print("=== {}".format(label))
+            sys.stdout.flush()
+            subprocess.run([sys.executable, 'benchmark.py'] + list(names), cwd=directory, check=True)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] in ('suite', 'compare', 'against'):
+        globals()['do_' + sys.argv[1]](*sys.argv[2:])
+        sys.exit(0)
+
+    if len(sys.argv) > 1:
+        benchmarks = [globals()[arg] for arg in sys.argv[1:]]
+    else:
+        benchmarks = [value for name, value in dict(globals()).items() if name.startswith('bench_') and callable(value)]
+
+    for benchmark in benchmarks:
+        print("{}: {}".format(benchmark.__name__, benchmark.__doc__))
+        benchmark()
+        print()
@@ -0,0 +1,387 @@
+#!/usr/bin/env python3
+"""
+Grammars compiled into plain tables: integer coded symbols, which
+non-terminals are nullable, their FIRST sets and which rules predicting a
+non-terminal leads to. Callbacks are referred to by name through a registry,
+so a compiled grammar can be pickled and sent to worker processes. It is
+cached on disk, so it is only analysed once: a grammar given by name until
+one of the files its rules come from changes, other grammars by a hash.
+
+Loading a grammar from the cache only saves importing the module that builds
+it if its callbacks are registered, and its terminals are classes from a
+module that does not build the grammar too. The hasl1 grammars define their
+terminals next to the rules, so unpickling them still builds the grammar,
+and a callback referred to as module:grammar#n imports and orders its
+grammar the first time it is called.
+
+Usage: python3 compiled.py hasl1.grammar:hasl1_grammar
+Without a grammar it runs the tests.
+"""
+import hashlib
+import importlib
+import os
+import pickle
+import re
+import sys
+import time
+from typing import List, Dict, Tuple, FrozenSet, Optional, Any, Callable, Iterable, Union
+
+from parser import Parser, Rule, RuleRef, Symbol
+
+CACHE = os.path.join(os.path.dirname(os.path.abspath(__file__)), '__grammarcache__')
+
+# Bump when the layout of CompiledGrammar changes, so old cache entries are ignored
+VERSION = 2
+
+registry = dict()  # type: Dict[str, Any]
+
+
+def register(name: Optional[str] = None):
+    """Decorator that makes a callback known under a name (its qualified name by default)"""
+    def wrapper(callback):
+        registry[name if name is not None else '{}:{}'.format(callback.__module__, callback.__qualname__)] = callback
+        return callback
+    return wrapper
+
+
+def resolve(name: str) -> Any:
+    """
+    The object registered under a name, or else found by importing it. Names
+    look like module:attribute, where attribute can be a dotted path. A name
+    like module:grammar#12 refers to the callback of the 13th rule of that
+    grammar, in the order of ordered().
+    """
+    if name not in registry:
+        module, _, path = name.partition(':')
+        match = re.fullmatch(r'(.+)#(\d+)', path)
+        value = importlib.import_module(module)
+        for attribute in (match.group(1) if match else path).split('.'):
+            value = getattr(value, attribute)
+        if match:
+            value = ordered(value)[int(match.group(2))].callback
+        registry[name] = value
+    return registry[name]
+
+
+def qualified_name(value: Any) -> Optional[str]:
+    """The name resolve() finds the value by, if there is one"""
+    for name, registered in registry.items():
+        if registered is value:
+            return name
+    try:
+        name = '{}:{}'.format(value.__module__, value.__qualname__)
+    except AttributeError:
+        return None
+    if '<' in name:  # lambdas and locals
+        return None
+    try:
+        return name if resolve(name) is value else None
+    except (ImportError, AttributeError):
+        return None
+
+
+def ordered(rules: Iterable[Rule]) -> List[Rule]:
+    """The rules in an order that is the same in every process, also for sets"""
+    if isinstance(rules, (set, frozenset)):
+        # Rules made on the same line (e.g. in a loop) look alike, but were
+        # still made in the same order every time.
+        return sorted(rules, key=lambda rule: (rule.file or '', rule.line or 0, rule.name, repr(rule), rule.id))
+    return list(rules)
+
+
+class Callback:
+    """Refers to a callback by name, and only looks it up when it is called."""
+    __slots__ = ('name', 'function')
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.function = None  # type: Optional[Callable]
+
+    def __call__(self, state, data):
+        if self.function is None:
+            self.function = resolve(self.name)
+        return self.function(state, data)
+
+    def __repr__(self) -> str:
+        return 'Callback({!r})'.format(self.name)
+
+
+class CompiledGrammar:
+    """
+    Non-terminals are coded as n >= 0 (see names), terminals as -(n + 1) (see
+    terminals). Each production is (lhs, rhs, callback name, file, line).
+    """
+
+    def __init__(self, rules: Iterable[Rule], source: Optional[str] = None) -> None:
+        rules = ordered(rules)
+        self.source = source
+        self.digest = digest(rules, source)
+        self.names = []  # type: List[str]
+        self.terminals = []  # type: List[Symbol]
+        self.productions = []  # type: List[Tuple[int, Tuple[int, ...], str, Optional[str], Optional[int]]]
+
+        codes = dict()  # type: Dict[str, int]
+        terminal_codes = dict()  # type: Dict[int, int]
+
+        def code(name: str) -> int:
+            if name not in codes:
+                codes[name] = len(self.names)
+                self.names.append(name)
+            return codes[name]
+
+        def terminal_code(symbol: Symbol) -> int:
+            if id(symbol) not in terminal_codes:
+                terminal_codes[id(symbol)] = -(len(self.terminals) + 1)
+                self.terminals.append(symbol)
+            return terminal_codes[id(symbol)]
+
+        for n, rule in enumerate(rules):
+            lhs = code(rule.name)
+            rhs = tuple(code(symbol.name) if isinstance(symbol, RuleRef) else terminal_code(symbol) for symbol in rule.symbols)
+            self.productions.append((lhs, rhs, reference(rule, n, source), rule.file, rule.line))
+
+        self.nullable = self._nullable()  # type: List[bool]
+        self.first = self._first()  # type: List[FrozenSet[int]]
+        self.predictions = self._predictions()  # type: List[Tuple[int, ...]]
+        self._rules = None  # type: Optional[List[Rule]]
+
+        files = {rule.file for rule in rules if rule.file is not None}
+        module = sys.modules.get(source.partition(':')[0]) if source is not None else None
+        if getattr(module, '__file__', None) is not None:
+            files.add(module.__file__)
+        self.files = stamps(sorted(files))  # type: Dict[str, Optional[Tuple[int, int]]]
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['_rules'] = None
+        return state
+
+    def symbol(self, code: int) -> Symbol:
+        return RuleRef(self.names[code]) if code >= 0 else self.terminals[-code - 1]
+
+    def rules(self) -> List[Rule]:
+        """Rules for parser.Parser, with callbacks that are only looked up when they are called"""
+        if self._rules is None:
+            self._rules = [Rule(self.names[lhs], [self.symbol(code) for code in rhs], Callback(callback), file=file, line=line)
+                           for lhs, rhs, callback, file, line in self.productions]
+        return self._rules
+
+    def parser(self, start: str, **options) -> Parser:
+        """A parser.Parser for the rules, that uses the nullable and prediction tables instead of working them out again"""
+        return Parser(self.rules(), start, compiled=self, **options)
+
+    def _nullable(self) -> List[bool]:
+        nullable = [False] * len(self.names)
+        changed = True
+        while changed:
+            changed = False
+            for lhs, rhs, *_ in self.productions:
+                if not nullable[lhs] and all(code >= 0 and nullable[code] for code in rhs):
+                    nullable[lhs] = changed = True
+        return nullable
+
+    def _first(self) -> List[FrozenSet[int]]:
+        first = [set() for _ in self.names]  # type: List[set]
+        changed = True
+        while changed:
+            changed = False
+            for lhs, rhs, *_ in self.productions:
+                before = len(first[lhs])
+                for code in rhs:
+                    if code < 0:
+                        first[lhs].add(code)
+                        break
+                    first[lhs] |= first[code]
+                    if not self.nullable[code]:
+                        break
+                changed = changed or len(first[lhs]) != before
+        return [frozenset(terminals) for terminals in first]
+
+    def _predictions(self) -> List[Tuple[int, ...]]:
+        """For each non-terminal, all productions that predicting it (transitively) predicts"""
+        by_lhs = [[] for _ in self.names]  # type: List[List[int]]
+        for n, (lhs, *_) in enumerate(self.productions):
+            by_lhs[lhs].append(n)
+
+        predictions = []
+        for name in range(len(self.names)):
+            seen = {name}
+            todo = [name]
+            for current in todo:
+                for n in by_lhs[current]:
+                    for code in self.productions[n][1]:
+                        if code < 0:
+                            break
+                        if code not in seen:
+                            seen.add(code)
+                            todo.append(code)
+                        if not self.nullable[code]:
+                            break
+            predictions.append(tuple(sorted(n for current in seen for n in by_lhs[current])))
+        return predictions
+
+
+def reference(rule: Rule, n: int, source: Optional[str]) -> str:
+    """The name of the rule's callback in the registry"""
+    name = rule.callback.name if isinstance(rule.callback, Callback) else qualified_name(rule.callback)
+    if name is not None:
+        return name
+    if source is not None:
+        return '{}#{}'.format(source, n)
+    raise ValueError('Cannot refer to the callback of {!r} by name: register it, or compile the grammar with its source'.format(rule))
+
+
+def stable(value: Any) -> str:
+    """A representation of a symbol key that is the same in every process: sets are sorted and classes go by name"""
+    if isinstance(value, (set, frozenset)):
+        return '{' + ', '.join(sorted(map(stable, value))) + '}'
+    if isinstance(value, (tuple, list)):
+        return '(' + ', '.join(map(stable, value)) + ')'
+    if isinstance(value, type):
+        return '{}:{}'.format(value.__module__, value.__qualname__)
+    return repr(value)
+
+
+def digest(rules: List[Rule], source: Optional[str] = None) -> str:
+    """Hash of everything that goes into a compiled grammar"""
+    hash = hashlib.sha1(repr((VERSION, source)).encode())
+    for n, rule in enumerate(rules):
+        hash.update(repr((rule.name, reference(rule, n, source), rule.file, rule.line)).encode())
+        for symbol in rule.symbols:
+            # The key of a symbol is what it tests for, except when it is
+            # just the identity of the symbol (see Symbol.key)
+            if type(symbol).key is Symbol.key:
+                hash.update(pickle.dumps(symbol))
+            else:
+                hash.update(stable(symbol.key).encode())
+    return hash.hexdigest()
+
+
+def stamps(files: Iterable[str]) -> Dict[str, Optional[Tuple[int, int]]]:
+    """The modification time and size of each file (None if it is gone), to tell whether any of them changed"""
+    stamps = dict()  # type: Dict[str, Optional[Tuple[int, int]]]
+    for file in files:
+        try:
+            stat = os.stat(file)
+            stamps[file] = (stat.st_mtime_ns, stat.st_size)
+        except OSError:
+            stamps[file] = None
+    return stamps
+
+
+def cached(path: str) -> Optional[CompiledGrammar]:
+    """The compiled grammar in the cache file, if there is one"""
+    try:
+        with open(path, 'rb') as fh:
+            return pickle.load(fh)
+    except FileNotFoundError:
+        return None
+
+
+def load(grammar: Union[str, Iterable[Rule]], source: Optional[str] = None, cache: Optional[str] = CACHE) -> CompiledGrammar:
+    """
+    Compiles a grammar, or loads it from the cache if it was compiled before.
+    The grammar is either a list or set of rules, or the name of one (e.g.
+    'hasl1.grammar:hasl1_grammar'), which also serves as its source.
+
+    A grammar given by name is cached under that name, and is not looked up
+    or analysed again as long as the files its rules come from (see files)
+    stay the same. Unpickling it still imports the modules of its terminals.
+    Other grammars are cached by their digest().
+    """
+    if isinstance(grammar, str):
+        source = grammar
+        if cache is not None:
+            path = os.path.join(cache, '{}.pickle'.format(hashlib.sha1(repr((VERSION, source)).encode()).hexdigest()))
+            compiled = cached(path)
+            if compiled is not None and compiled.files == stamps(compiled.files):
+                return compiled
+        grammar = resolve(grammar)
+        rules = ordered(grammar)
+    else:
+        rules = ordered(grammar)
+        if cache is not None:
+            path = os.path.join(cache, '{}.pickle'.format(digest(rules, source)))
+            compiled = cached(path)
+            if compiled is not None:
+                return compiled
+
+    compiled = CompiledGrammar(rules, source)
+    if cache is None:
+        return compiled
+    os.makedirs(cache, exist_ok=True)
+    # Write to a temporary file first, so other processes never see half of it
+    temporary = '{}.{}'.format(path, os.getpid())
+    with open(temporary, 'wb') as fh:
+        pickle.dump(compiled, fh, pickle.HIGHEST_PROTOCOL)
+    os.replace(temporary, path)
+    return compiled
+
+
+def test_round_trip():
+    """Test that a compiled grammar parses the same after pickling, and is found in the cache again"""
+    import subprocess
+    import tempfile
+    from parser import Literal
+
+    @register('test:pair')
+    def pair(state, data):
+        return (data[0], data[1])
+
+    @register('test:word')
+    def word(state, data):
+        return str(data[0])
+
+    rules = [
+        Rule('S', [RuleRef('S'), RuleRef('S')], pair),
+        Rule('S', [RuleRef('W')], word),
+        Rule('W', [Literal('a')], word),
+        Rule('W', [Literal('b')], word),
+    ]
+    tokens = list('abab')
+    expected = sorted(repr(result['data']) for result in Parser(rules, 'S').parse(tokens))
+    with tempfile.TemporaryDirectory() as cache:
+        compiled = load(rules, cache=cache)
+        copy = pickle.loads(pickle.dumps(compiled))
+        for parser in (copy.parser('S'), Parser(copy.rules(), 'S')):
+            assert sorted(repr(result['data']) for result in parser.parse(tokens)) == expected
+        assert load(set(rules), cache=cache).digest == compiled.digest
+        assert len(os.listdir(cache)) == 1
+
+    # Lambdas cannot be found again by name
+    try:
+        CompiledGrammar([Rule('S', [Literal('a')], lambda state, data: data)])
+        assert False, 'no error'
+    except ValueError:
+        pass
+
+    # Keys that hold sets hash the same in every process
+    script = '\n'.join([
+        'import compiled, parser',
+        'class Word(parser.Symbol):',
+        '    def __init__(self):',
+        '        self.exclude = frozenset(["a", "b", "c", "d", "e", "f"])',
+        '    key = property(lambda self: (type(self), self.exclude))',
+        'print(compiled.digest([parser.Rule("S", [Word()], compiled.Callback("test:word"))]))',
+    ])
+    digests = {subprocess.run([sys.executable, '-c', script], env=dict(os.environ, PYTHONHASHSEED=str(seed)),
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True, stdout=subprocess.PIPE).stdout
+               for seed in range(4)}
+    assert len(digests) == 1, digests
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 1:
+        test_round_trip()
+        print("Done.")
+
+    for name in sys.argv[1:]:
+        start = time.perf_counter()
+        compiled = load(name)
+        loaded = time.perf_counter()
+        copy = pickle.loads(pickle.dumps(compiled))
+        copy.rules()
+        end = time.perf_counter()
+        print("{}: {} rules, {} non-terminals ({} nullable), {} terminals".format(
+            name, len(compiled.productions), len(compiled.names), sum(compiled.nullable), len(compiled.terminals)))
+        print("  load {:.2f} ms, unpickle and rebuild rules {:.2f} ms".format((loaded - start) * 1000, (end - loaded) * 1000))
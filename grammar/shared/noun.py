@@ -14,6 +14,10 @@ class NounParser(Symbol):
     def __repr__(self):
         return 'NounParser({})'.format('plural' if self.is_plural else 'singular')
 
+    @property
+    def key(self):
+        return (type(self), self.is_plural)
+
     def test(self, literal: str, position: int, state: 'State') -> bool:
         # Is it a name?
         if not literal.islower() and position != 0: 
@@ -52,6 +52,10 @@ class VerbParser(Symbol):
     def __repr__(self) -> str:
         return "/{}/".format(self.expression.pattern)
 
+    @property
+    def key(self):
+        return (type(self), self.expression.pattern, self.negate)
+
     def finish(self, literal: str, position: int, state: State):
         return Interpretation(local=Verb(literal))
 
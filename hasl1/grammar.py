@@ -5,6 +5,7 @@ import traceback
 import operator
 import re
 import inspect
+import linecache
 from pprint import pprint
 from functools import reduce
 from itertools import chain
@@ -14,7 +15,7 @@ import spacy
 
 import english
 import parser
-from parser import Rule, RuleRef, passthru, Continue
+from parser import Rule, RuleRef, passthru, Parser
 
 
 def coalesce(*args):
@@ -220,6 +221,10 @@ class Tag(parser.Symbol):
     def __repr__(self):
         return '<{}>'.format(self.tag.pattern)
 
+    @property
+    def key(self):
+        return (type(self), self.tag.pattern, self.exclude)
+
     def test(self, literal, position, state):
         return self.tag.fullmatch(literal.tag_) and str(literal) not in self.exclude
 
@@ -235,6 +240,10 @@ class Literal(parser.Symbol):
     def __repr__(self):
         return '"{}"'.format(self.literal.pattern)
 
+    @property
+    def key(self):
+        return (type(self), self.literal.pattern, self.exclude)
+
     def test(self, literal, position, state):
         return self.literal.fullmatch(str(literal)) and str(literal) not in self.exclude
 
@@ -332,6 +341,38 @@ class Entity(object):
 
 
 
+class Provenance(object):
+    """
+    How claims and relations remember the code that made them: not at all,
+    by file and line only, or also with the source line read from disk right
+    away (which is what inspect.getframeinfo() does). Set Provenance.mode.
+    """
+    OFF = 'off'
+    LOCATION = 'location'
+    FULL = 'full'
+
+    mode = LOCATION
+
+    @classmethod
+    def capture(cls, frame):
+        """(file, line, source) of the frame, as far as the mode records them"""
+        if cls.mode == cls.OFF:
+            return None, None, None
+        elif cls.mode == cls.FULL:
+            file, line, _, context, _ = inspect.getframeinfo(frame)
+            return file, line, context[0].strip() if context else None
+        else:
+            return frame.f_code.co_filename, frame.f_lineno, None
+
+    @staticmethod
+    def tooltip(file, line, source=None):
+        if file is None:
+            return "Created in unknown place (provenance is off)"
+        if source is None:
+            source = linecache.getline(file, line).strip()
+        return "Created in {}: {}\n{}".format(file, line, source)
+
+
 class Claim(object):
     def __init__(self, subj, verb, negated=False, assumed=False, file=None, line=None):
         self.subj = subj
@@ -341,9 +382,9 @@ class Claim(object):
         if file is not None:
             self.file = file
             self.line = line
+            self.source = None
         else:
-            previous_frame = inspect.currentframe().f_back
-            (self.file, self.line, *_) = inspect.getframeinfo(previous_frame)
+            (self.file, self.line, self.source) = Provenance.capture(inspect.currentframe().f_back)
 
     def __eq__(self, other):
         return str(self).lower() == str(other).lower()
@@ -359,7 +400,7 @@ class Claim(object):
 
     @property
     def tooltip(self):
-        return "Created in {}: {}".format(self.file, self.line)
+        return Provenance.tooltip(self.file, self.line, self.source)
 
     @property
     def entities(self):
@@ -395,9 +436,9 @@ class Relation(object):
         if file is not None:
             self.file = file
             self.line = line
+            self.source = None
         else:
-            previous_frame = inspect.currentframe().f_back
-            (self.file, self.line, *_) = inspect.getframeinfo(previous_frame)
+            (self.file, self.line, self.source) = Provenance.capture(inspect.currentframe().f_back)
 
     def __str__(self):
         return "({} {} {})".format(' ^ '.join(str(s) for s in self.sources), self.arrows[self.type], self.target)
@@ -405,6 +446,10 @@ class Relation(object):
     def __repr__(self):
         return "({} {} {}) ({}:{})".format(self.sources, self.arrows[self.type], self.target, self.file, self.line)
 
+    @property
+    def tooltip(self):
+        return Provenance.tooltip(self.file, self.line, self.source)
+
     def __hash__(self):
         return hash((self.type, self.sources, self.target))
 
@@ -513,6 +558,13 @@ class Argument(object):
             mapping=mapping)
 
 
+def simplest(state, data):
+    """Score for parser.Parser that ranks arguments with fewer assumptions, and then fewer relations, first"""
+    if not isinstance(data, Argument):
+        return (0, 0)
+    return (sum(1 for claim in data.claims if claim.assumed), len(data.relations))
+
+
 class Grammar(object):
     def __init__(self, rules = None):
         self.rules = rules if rules is not None else []
@@ -527,9 +579,9 @@ class Grammar(object):
         return self.__class__(rule for rule in self.rules if rule.name not in names)
 
     def rule(self, name, symbols):
+        # See parser.Rule, getframeinfo() would read the source for every rule
         previous_frame = inspect.currentframe().f_back
-        (filename, line_number, function_name, lines, index) = inspect.getframeinfo(previous_frame)
-        rule = Rule(name, symbols, file=filename, line=line_number)
+        rule = Rule(name, symbols, file=previous_frame.f_code.co_filename, line=previous_frame.f_lineno)
         self.rules.append(rule)
         def wrapper(callback):
             rule.callback = lambda state, data: callback(*data)
@@ -893,10 +945,11 @@ def hasl1_attack_general(conclusion, but, specific):
 
 class GeneralClaim(Claim):
     def __init__(self, *args, conditions=tuple(), file=None, line=None, **kwargs):
+        source = None
         if file is None:
-            previous_frame = inspect.currentframe().f_back
-            (file, line, *_) = inspect.getframeinfo(previous_frame)
+            (file, line, source) = Provenance.capture(inspect.currentframe().f_back)
         super().__init__(*args, file=file, line=line, **kwargs)
+        self.source = source
         self.conditions = tuple(conditions)
 
     def __str__(self):
@@ -952,7 +1005,7 @@ def hasl1_support_general_missing_general(conclusion, because, specifics):
         # Special case: if the specific is the conclusion, but only assumed, just pass it on including the conclusion
         # which will override the assumed conclusion.
         if len(specifics.roots) == 1 and specifics.root == conclusion:
-            raise Continue('A because A')
+            return Parser.FAIL  # A because A
         subj = Entity()
         conditions = [Claim(subj, specific.verb, negated=specific.negated, assumed=True) for specific in specifics.roots]
         general = GeneralClaim(subj, conclusion.verb, negated=conclusion.negated, conditions=tuple(conditions), assumed=True)
@@ -960,14 +1013,14 @@ def hasl1_support_general_missing_general(conclusion, because, specifics):
         warrant = Relation('support', [general], support)
         return Argument(claims=[general, conclusion, *specifics.claims], relations=[*specifics.relations, support, warrant])
     except:
-        raise Continue("could not combine {!r} with {!r}".format(conclusion, specifics))
+        return Parser.FAIL  # could not combine conclusion with specifics
 
 
 @hasl1_grammar.rule('specific-argument', [RuleRef('specific-claim'), Literal('because'), RuleRef('specific-arguments'), Literal('but'), RuleRef('specific-argument')])
 def hasl1_support_general_missing_general_with_undercutter(conclusion, because, specifics, but, attack):
     """(a <~ b) <~ C"""
     if len(specifics.roots) == 1 and specifics.root == conclusion:
-        raise Continue('A because A')
+        return Parser.FAIL  # A because A
 
     subj = Entity()
     conditions = [Claim(subj, specific.verb, negated=specific.negated, assumed=True) for specific in specifics.roots]
@@ -988,7 +1041,7 @@ def hasl1_support_general_missing_conclusion(specifics, conj, general):
         warrant = Relation('support', [general.root], support)
         return Argument(claims=[*specifics, *expected_specifics, *general.claims, conclusion], relations=[*general.relations, support, warrant])
     except:
-        raise Continue("could not combine {!r} with {!r}".format(specifics, general))
+        return Parser.FAIL  # could not combine specifics with general
 
 """
 > a because (b but c): a<~b; b*-c
@@ -11,20 +11,10 @@ import flask
 import spacy
 
 import parser
-from hasl1.grammar import hasl0_grammar, hasl1_grammar, Claim, Relation, Argument, Entity, Span, id
+from hasl1.grammar import hasl0_grammar, hasl1_grammar, Claim, Relation, Argument, Entity, Span, id, simplest
 from flask import Flask, render_template, request, jsonify
 
 
-def unique(iterable, key = lambda x: x):
-    elements = []
-    seen = set()
-    for el in iterable:
-        if key(el) not in seen:
-            elements.append(el)
-            seen.add(key(el))
-    return elements
-
-
 class TokenizeError(Exception):
     pass
 
@@ -122,13 +112,42 @@ def api_parse_sentence():
         except:
             raise Exception('Grammar {} not available'.format(grammar_name));
 
-        p = parser.Parser(grammar, 'sentences')
-        parses = p.parse(tokens)
-        reply['parses'] = unique(parses, key=lambda parse: parse['data'])
+        # Parses with the same data are the same reading: count each once.
+        # Ranking them by simplest() needs all of them, so the limit only cuts
+        # off the reply: the parser does not stop any earlier. (A beam would,
+        # but simplest() cannot rank partial arguments, so it would drop
+        # readings at random.)
+        p = parser.Parser(grammar, 'sentences', limit=20, score=simplest, precheck=True, distinct=lambda data: data)
+        reply['parses'] = p.parse(tokens)
+
+        if p.found > 20:
+            reply['warning'] = 'There were {} parses, but cut off at {}'.format(p.found, 20)
+
+        return jsonify(reply)
+    except Exception as error:
+        traceback.print_exc()
+        reply['error'] = "{}: {!s}\n{}".format(error.__class__.__name__, error, traceback.format_exc())
+        response = jsonify(reply)
+        response.status_code = 400
+        return response
+
+@app.route('/api/expected', methods=['GET'])
+def api_expected():
+    """The terminals that can follow the sentence so far, for autocompletion"""
+    grammar_name = request.args.get('grammar')
+    tokens = nlp(request.args.get('sentence'))
+    reply = dict(tokens=tokens, grammar=grammar_name)
 
-        if len(reply['parses']) > 20:
-            reply['warning'] = 'There were {} parses, but cut off at {}'.format(len(reply['parses']), 20)
-            reply['parses'] = reply['parses'][:20]
+    try:
+        try:
+            grammar = grammars[grammar_name]
+        except:
+            raise Exception('Grammar {} not available'.format(grammar_name));
+
+        # Only recognizing, in forest mode no callbacks run while feeding
+        p = parser.Parser(grammar, 'sentences', forest=True)
+        p.feed(tokens)
+        reply['expected'] = [repr(symbol) for symbol in p.expected()]
 
         return jsonify(reply)
     except Exception as error:
@@ -138,5 +157,6 @@ def api_parse_sentence():
         response.status_code = 400
         return response
 
+
 def run():
     app.run(extra_files=sentence_files)
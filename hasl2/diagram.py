@@ -212,9 +212,9 @@ class Diagram(object):
 		while i < len(top_warrants):
 			for condition in top_warrants[i].conditions:
 				for claim in condition.claims:
-					if self.has_relations(target=claim._ref, type=Type.CONDITION) \
-						and not self.has_relations(target=claim._ref, type=Type.EXCEPTION):
-						top_warrants.append(self.to_warrant({'sources': [claim._ref]}))
+					if self.has_relations(target=claim.ref, type=Type.CONDITION) \
+						and not self.has_relations(target=claim.ref, type=Type.EXCEPTION):
+						top_warrants.append(self.to_warrant({'sources': [claim.ref]}))
 			i += 1
 		
 		if len(top_warrants) > 0:
@@ -233,9 +233,9 @@ class Diagram(object):
 		while i < len(top_warrants):
 			for condition in top_warrants[i].conditions:
 				for claim in condition.claims:
-					if self.has_relations(target=claim._ref, type=Type.CONDITION) \
-							and not self.has_relations(target=claim._ref, type=Type.EXCEPTION):
-						top_warrants.append(self.to_warrant({'sources': [claim._ref]}))
+					if self.has_relations(target=claim.ref, type=Type.CONDITION) \
+							and not self.has_relations(target=claim.ref, type=Type.EXCEPTION):
+						top_warrants.append(self.to_warrant({'sources': [claim.ref]}))
 			i += 1
 
 		if len(top_warrants) > 0:
@@ -274,9 +274,7 @@ class Diagram(object):
 		assert claim['isa'] == 'claim'
 		if 'text' not in claim:
 			claim = self.claims[claim['id']]
-		obj = Claim(text=Text([self._decapitalize(claim['text'])]))
-		setattr(obj, '_ref', claim)
-		return obj
+		return Claim(text=Text([self._decapitalize(claim['text'])]), ref=claim)
 
 	@classmethod
 	def from_object(cls, obj: dict) -> 'Diagram':
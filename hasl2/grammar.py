@@ -3,11 +3,18 @@ from functools import partial, reduce
 from itertools import takewhile
 import operator
 from typing import NamedTuple, List, Optional, Any
-from hasl2.parser import ruleset, rule, tlist, template, l, slot, empty, terminal, NoMatchException, sparselist
+from hasl2.parser import ruleset, rule, tlist, template, l, slot, empty, terminal, NoMatchException, bindings, hashconsed
 
+@hashconsed
 class Text(object):
+	__slots__ = ('words', '_hash')
+
 	def __init__(self, words):
-		self.words = tuple(words)
+		object.__setattr__(self, 'words', tuple(words))
+		object.__setattr__(self, '_hash', hash((type(self), self.words)))
+
+	def __setattr__(self, name, value):
+		raise AttributeError("{} is immutable".format(type(self).__name__))
 
 	def __str__(self):
 		return " ".join(self.words)
@@ -16,7 +23,10 @@ class Text(object):
 		return "Text('{}')".format(str(self))
 
 	def __eq__(self, other):
-		return type(self) == type(other) and self.words == other.words
+		return self is other or (type(self) == type(other) and self._hash == other._hash and self.words == other.words)
+
+	def __hash__(self):
+		return self._hash
 
 	def __add__(self, other):
 		return type(self)(self.words + other.words)
@@ -27,41 +37,57 @@ class Text(object):
 		return type(self)(self.words[len(other.words):])
 
 
+@hashconsed
 class Claim(object):
-	def __init__(self, text):
-		self.text = text
+	__slots__ = ('text', 'ref', '_hash')
+
+	def __init__(self, text, ref = None):
+		object.__setattr__(self, 'text', text)
+		object.__setattr__(self, 'ref', ref) # The claim node of a diagram it came from, which is not part of its value
+		object.__setattr__(self, '_hash', hash((type(self), text)))
+
+	def __setattr__(self, name, value):
+		raise AttributeError("{} is immutable".format(type(self).__name__))
 
 	def __repr__(self):
 		return "Claim('{}')".format(str(self.text))
 
 	def __eq__(self, other):
-		return type(self) == type(other) and self.text == other.text
+		return self is other or (type(self) == type(other) and self._hash == other._hash and self.text == other.text)
+
+	def __hash__(self):
+		return self._hash
 
 	def map(self, func):
 		return type(self)(func(self.text))
 
 
+@hashconsed
 class Argument(NamedTuple):
 	claim: Claim
 	supports: List['Support']
 	attack: Optional['Attack']
 
 
+@hashconsed
 class Attack(NamedTuple):
 	claims: List[Argument]
 
 
+@hashconsed
 class Support(NamedTuple):
 	datums: List[Claim]
 	warrant: Optional['Warrant']
 	undercutter: Optional[Argument]
 
 
+@hashconsed
 class Warrant(NamedTuple):
 	claim: Claim
 	conditions: List['WarrantCondition'] # in Disjunctive Normal Form
 
 
+@hashconsed
 class WarrantCondition(NamedTuple):
 	claims: List[Claim] # Conjunctive
 	exceptions: List['WarrantException'] # idem.
@@ -70,6 +96,7 @@ class WarrantCondition(NamedTuple):
 		return type(self)(tuple(map(func, self.claims)))
 
 
+@hashconsed
 class WarrantException(NamedTuple):
 	claims: List[Claim] # Conjunctive
 
@@ -285,9 +312,9 @@ class Action(Claim):
 	object: Claim
 
 	def __init__(self, subject, verb, object):
-		self.subject = subject
-		self.verb = verb
-		self.object = object
+		super(Claim, self).__setattr__('subject', subject)
+		super(Claim, self).__setattr__('verb', verb)
+		super(Claim, self).__setattr__('object', object)
 		super().__init__(text=subject + verb + object.text)
 		
 
@@ -309,7 +336,7 @@ class prepend(object):
 		subject = Text(x[0] for x in prefix_tuples)
 		object = self._apply(partial(self._remove, subject), structure)
 
-		flat = sparselist()
+		flat = bindings()
 		flat |= self.subject.reverse(subject)
 		flat |= self.object.reverse(object)
 
@@ -392,7 +419,7 @@ def concatenate(tokens):
 
 def parse(sentence, start = 'sentences'):
 	from hasl2.parser import Parser
-	parser = Parser(rules)
+	parser = Parser(rules, packrat=True)
 	tokens = tokenize(rules.markers(), sentence)
 	return parser.parse(start, tokens)
 
@@ -2,7 +2,7 @@ from typing import NamedTuple, List, Set, FrozenSet, Union, Optional
 from collections.abc import Sequence
 from pprint import pprint, pformat
 from collections import defaultdict
-from itertools import chain
+from itertools import chain, islice
 from functools import reduce, wraps
 from operator import add
 
@@ -10,22 +10,96 @@ from operator import add
 DEBUG = False
 
 
-def debug(*args, **kwargs):
+def debug(message, *args):
+	# Only formats the message when debugging, as it contains whole trees
 	if DEBUG:
-		print("DEBUG:", *args, **kwargs)
+		print("DEBUG:", message.format(*args))
+
+
+def frozen(structure):
+	"""
+	A hashable stand-in for a structure, which is equal for structures that
+	are equal and of the same type. Objects that are neither hashable nor have
+	attributes stand in for themselves only.
+	"""
+	if isinstance(structure, (list, tuple)):
+		return (type(structure), tuple(map(frozen, structure)))
+	try:
+		hash(structure)
+		return (type(structure), structure)
+	except TypeError:
+		pass
+	if hasattr(structure, '__dict__'):
+		return (type(structure), tuple(sorted((name, frozen(value)) for name, value in vars(structure).items())))
+	return (type(structure), id(structure))
+
+
+def unique(iterable):
+	seen = set()
+	for el in iterable:
+		key = frozen(el)
+		if key not in seen:
+			seen.add(key)
+			yield el
+
+
+class shared(object):
+	"""
+	An iterable that is filled from an iterator while it is read, so several
+	readers can share the items without producing any of them twice, and
+	none of them are produced before someone reads them. Reading it from
+	within its own iterator ends the read.
+	"""
+	__slots__ = ('iterator', 'items', 'busy')
+
+	def __init__(self, iterable):
+		self.iterator = iter(iterable)
+		self.items = []
+		self.busy = False
+
+	def __iter__(self):
+		n = 0
+		while True:
+			if n < len(self.items):
+				yield self.items[n]
+			elif self.iterator is None or self.busy:
+				return
+			else:
+				self.busy = True
+				try:
+					self.items.append(next(self.iterator))
+				except StopIteration:
+					self.iterator = None
+					return
+				finally:
+					self.busy = False
+				yield self.items[n]
+			n += 1
 
 
 def unique_generator(f):
 	@wraps(f)
 	def filter(*args, **kwargs):
-		seen = list()
-		for el in f(*args, **kwargs):
-			if el not in seen:
-				seen.append(el)
-				yield el
+		return unique(f(*args, **kwargs))
 	return filter
 
 
+def hashconsed(cls):
+	"""
+	Class decorator for immutable, hashable value types, of which the parser
+	shares equal values within a parse (see Parser.intern). Tuple types, like
+	NamedTuples, are made to only equal values of the same type: otherwise an
+	Attack would be interchangeable with a WarrantException with the same
+	claims, or with a plain tuple.
+	"""
+	if issubclass(cls, tuple):
+		cls.__eq__ = lambda self, other: self is other or (type(self) is type(other) and tuple.__eq__(self, other))
+		cls.__ne__ = lambda self, other: not self == other
+		cls.__hash__ = lambda self: hash((type(self), tuple.__hash__(self)))
+	cls.hashconsed = True
+	return cls
+
+
 class sparseobject(object):
 	def __init__(self, **kwargs):
 		self.__dict__ = kwargs
@@ -85,6 +159,73 @@ class sparselist(list):
 		return merged
 
 
+class bindings(object):
+	"""
+	What reversing a template found for the slots of a rule: an immutable map
+	from index to value, with the same rules as sparselist (unset indexes are
+	None, and an index can only be set again to an equal value, or merged if
+	both are sparseobjects.) Unlike sparselist, combining two of them does not
+	copy: the union shares the left one and only adds what the right one has.
+	"""
+	__slots__ = ('index', 'value', 'parent', 'length')
+
+	def __init__(self, index = None, value = None, parent = None):
+		self.index = index
+		self.value = value
+		self.parent = parent
+		self.length = parent.length if parent is not None else 0
+		if index is not None:
+			self.length = max(self.length, index + 1)
+
+	def __len__(self):
+		return self.length
+
+	def __getitem__(self, index):
+		node = self
+		while node is not None:
+			if node.index == index:
+				return node.value
+			node = node.parent
+		return None
+
+	def __iter__(self):
+		return (self[n] for n in range(self.length))
+
+	def __repr__(self):
+		return 'bindings({!r})'.format(list(self))
+
+	def items(self):
+		seen = set()
+		node = self
+		while node is not None:
+			if node.index is not None and node.index not in seen:
+				seen.add(node.index)
+				yield node.index, node.value
+			node = node.parent
+
+	def __or__(self, other):
+		assert isinstance(other, bindings)
+		if len(other) == 0:
+			return self
+		if len(self) == 0:
+			return other
+		merged = self
+		for index, value in other.items():
+			current = self[index]
+			if value is None:
+				if index < len(merged):
+					continue
+			elif current is not None:
+				if current == value:
+					continue
+				elif isinstance(current, sparseobject) and isinstance(value, sparseobject):
+					value = current | value
+				else:
+					raise Exception('Trying to overwrite already set value at index {} in bindings: {!r} = {!r}'.format(index, current, value))
+			merged = type(self)(index, value, merged)
+		return merged
+
+
 class rule(object):
 	def __init__(self, name, tokens, template):
 		self.name = name
@@ -159,11 +300,11 @@ class template(object):
 			raise Exception("Not enough arguments for template {!r}: {}".format(self.template, pformat(args)))
 
 	def reverse(self, structure):
-		debug("template.reverse {!r} {!r}".format(self.pred, structure))
+		debug("template.reverse {!r} {!r}", self.pred, structure)
 		if not isinstance(structure, self.pred):
 			raise NoMatchException()
 
-		flat = sparselist()
+		flat = bindings()
 		for name, index in self.template.items():
 			if is_reversable(index):
 				flat = flat | index.reverse(getattr(structure, name))
@@ -195,9 +336,7 @@ class slot(object):
 	def reverse(self, structure):
 		if self.attribute is not None:
 			structure = sparseobject(**{self.attribute: structure})
-		flat = sparselist()
-		flat[self.index] = structure
-		return flat
+		return bindings(self.index, structure)
 
 
 class tlist(object):
@@ -230,7 +369,7 @@ class tlist(object):
 		if not isinstance(structure, Sequence):
 			raise NoMatchException('structure is not a sequence')
 
-		flat = sparselist()
+		flat = bindings()
 
 		if len(structure) < len(self.head):
 			raise NoMatchException('head is longer than structure')
@@ -257,16 +396,45 @@ class empty(object):
 
 	def reverse(self, structure):
 		if structure is None:
-			return []
+			return bindings()
 		else:
 			raise NoMatchException()
 
 
+class lookahead(object):
+	"""
+	The words a rule can start with: literals are looked up by their word,
+	other terminals (like a Word unit) are tested. A rule that can match
+	nothing also accepts what can follow it, and the end of the input (None).
+	"""
+	__slots__ = ('words', 'terminals', 'nullable')
+
+	def __init__(self, terminals, nullable):
+		self.words = frozenset(terminal.word for terminal in terminals if type(terminal) is l)
+		self.terminals = tuple(terminal for terminal in terminals if type(terminal) is not l)
+		self.nullable = nullable
+
+	def test(self, word):
+		if word is None:
+			return self.nullable
+		try:
+			if word in self.words:
+				return True
+		except TypeError: # Unhashable words can still be equal to a literal
+			if any(literal == word for literal in self.words):
+				return True
+		return any(terminal.test(word) for terminal in self.terminals)
+
+
 class ruleset(object):
 	def __init__(self, rules):
 		self.rules = defaultdict(lambda: [])
 		for rule in rules:
 			self.rules[rule.name].append(rule)
+		self._nullable = None
+		self._first = None
+		self._follow = None
+		self._lookahead = None
 
 	def __getitem__(self, name):
 		if name in self.rules:
@@ -305,6 +473,79 @@ class ruleset(object):
 						yield token.word
 		return frozenset(find_markers(self))
 
+	def nullable(self):
+		"""Names of the rules that can match no words at all"""
+		if self._nullable is None:
+			nullable = set()
+			changed = True
+			while changed:
+				changed = False
+				for rule in self:
+					if rule.name not in nullable and all(not is_literal(token) and token in nullable for token in rule.tokens):
+						nullable.add(rule.name)
+						changed = True
+			self._nullable = frozenset(nullable)
+		return self._nullable
+
+	def first(self):
+		"""For each rule name, the terminals the words it matches can start with"""
+		if self._first is None:
+			first = defaultdict(set)
+			changed = True
+			while changed:
+				changed = False
+				for rule in self:
+					before = len(first[rule.name])
+					first[rule.name] |= self._first_of(rule.tokens, first)[0]
+					changed = changed or len(first[rule.name]) != before
+			self._first = {name: frozenset(terminals) for name, terminals in first.items()}
+		return self._first
+
+	def follow(self):
+		"""For each rule name, the terminals that can come right after it"""
+		if self._follow is None:
+			first = self.first()
+			follow = defaultdict(set)
+			changed = True
+			while changed:
+				changed = False
+				for rule in self:
+					for n, token in enumerate(rule.tokens):
+						if is_literal(token):
+							continue
+						before = len(follow[token])
+						terminals, nullable = self._first_of(rule.tokens[n + 1:], first)
+						follow[token] |= terminals
+						if nullable:
+							follow[token] |= follow[rule.name]
+						changed = changed or len(follow[token]) != before
+			self._follow = {name: frozenset(terminals) for name, terminals in follow.items()}
+		return self._follow
+
+	def lookahead(self):
+		"""For each rule, the lookahead that tells whether it can match at the next word"""
+		if self._lookahead is None:
+			first, follow = self.first(), self.follow()
+			self._lookahead = dict()
+			for rule in self:
+				terminals, nullable = self._first_of(rule.tokens, first)
+				if nullable:
+					terminals = terminals | follow.get(rule.name, frozenset())
+				self._lookahead[rule] = lookahead(terminals, nullable)
+		return self._lookahead
+
+	def _first_of(self, tokens, first):
+		"""The terminals a sequence of tokens can start with, and whether it can match nothing"""
+		terminals = set()
+		for token in tokens:
+			if is_literal(token):
+				terminals.add(token)
+				return terminals, False
+			terminals |= first.get(token, frozenset())
+			if token not in self.nullable():
+				return terminals, False
+		return terminals, True
+
 
 def is_literal(obj):
 	return isinstance(obj, terminal)
@@ -323,24 +564,90 @@ class ParseException(Exception):
 
 
 class Parser(object):
-	def __init__(self, rules):
+	def __init__(self, rules, statistics = None, packrat = False, lookahead = True):
+		"""
+		Given an instrumentation.Statistics, the parser counts per rule how
+		often it was tried, completed and led nowhere, and the time its
+		template took, and records how deep the rules nested for each parse.
+
+		With packrat, each rule name is derived only once per position in the
+		input: its results are remembered for the rest of the parse, and
+		rules walk over the words by index instead of by slicing them. The
+		parses are the same, in the same order, but values of shared parts
+		are the same objects. Left recursion, on which the plain parser
+		recurses forever, is not an error: while a name is derived at a
+		position, deriving it there again finds nothing, so only the
+		derivations that do not start with the name itself are found.
+
+		With lookahead, alternatives that cannot start with the next word
+		(according to the FIRST and FOLLOW sets of the ruleset) are not tried.
+		"""
 		self.rules = rules
+		self.statistics = statistics
+		self.packrat = packrat
+		# A grammar that refers to names without rules fails when it gets to them, so leave it be
+		self.lookahead = rules.lookahead() if lookahead and len(rules.missing()) == 0 else None
+		self.depth = 0
+		self.words = ()
+		self.memo = dict()
+		self.values = dict()
 
 	# @unique_generator
 	def parse(self, rule_name, words):
-		for resolution, remaining_words in self._parse(rule_name, list(words)):
-			if len(remaining_words) == 0:
-				yield resolution
+		self.values = dict()
+		words = [self.intern(word) for word in words]
+		self.depth = 0
+		if self.packrat:
+			self.words = tuple(words)
+			self.memo = dict()
+			for resolution, end in self._parse_at(rule_name, 0):
+				if end == len(words):
+					yield resolution
+			self.memo = dict()
+		else:
+			for resolution, remaining_words in self._parse(rule_name, words):
+				if len(remaining_words) == 0:
+					yield resolution
+		self.values = dict()
+		if self.statistics is not None:
+			self.statistics.parsed(tokens=len(words), depth=self.depth)
 	
-	def _parse(self, rule_name, words):
+	def _parse(self, rule_name, words, depth = 1):
+		if self.statistics is not None:
+			self.depth = max(self.depth, depth)
 		for rule in self.rules[rule_name]:
+			if self.lookahead is not None and not self.lookahead[rule].test(words[0] if len(words) > 0 else None):
+				continue
+			if self.statistics is not None:
+				self.statistics[rule].predictions += 1
+			matched = False
 			try:
-				for acc, remaining_words in self._parse_rule(rule.tokens, words):
-					yield rule.template.consume(acc), remaining_words
+				for acc, remaining_words in self._parse_rule(rule.tokens, words, depth):
+					matched = True
+					if self.statistics is None:
+						yield self.intern(rule.template.consume(acc)), remaining_words
+					else:
+						self.statistics[rule].completions += 1
+						yield self.intern(self.statistics.call(rule, rule.template.consume, acc)), remaining_words
 			except:
 				raise ParseException("Error while parsing {!s}".format(rule))
+			if not matched and self.statistics is not None:
+				self.statistics[rule].backtracks += 1
+
+	def intern(self, value):
+		"""
+		The value equal to this one that was made earlier in this parse, if
+		its type is @hashconsed, so ambiguous parses share their common parts
+		and comparing those is a matter of identity.
+		"""
+		if getattr(value, 'hashconsed', False):
+			try:
+				return self.values.setdefault(value, value)
+			except TypeError: # A field holds something unhashable, like a list
+				pass
+		return value
 
-	def _parse_rule(self, tokens, words):
+	def _parse_rule(self, tokens, words, depth = 1):
 		if len(tokens) == 0:
 			yield [], words
 
@@ -348,44 +655,105 @@ class Parser(object):
 			if len(words) == 0 or not tokens[0].test(words[0]):
 				return
 			else:
-				for resolution, remaining_words in self._parse_rule(tokens[1:], words[1:]):
+				for resolution, remaining_words in self._parse_rule(tokens[1:], words[1:], depth):
 					yield [tokens[0].consume(words[0])] + resolution, remaining_words
 		else:
-			for resolution, remaining_words in self._parse(tokens[0], words):
-				for continuation, cont_remaining_words in self._parse_rule(tokens[1:], remaining_words):
+			for resolution, remaining_words in self._parse(tokens[0], words, depth + 1):
+				for continuation, cont_remaining_words in self._parse_rule(tokens[1:], remaining_words, depth):
 					yield [resolution] + continuation, cont_remaining_words
 
-	# @unique_generator
+	def _parse_at(self, rule_name, offset, depth = 1):
+		"""All (value, end offset) derivations of rule_name starting at offset"""
+		key = (rule_name, offset)
+		if key not in self.memo:
+			self.memo[key] = () # Stops left recursion
+			self.memo[key] = tuple(self._derive_at(rule_name, offset, depth))
+		return self.memo[key]
+
+	def _derive_at(self, rule_name, offset, depth):
+		if self.statistics is not None:
+			self.depth = max(self.depth, depth)
+		for rule in self.rules[rule_name]:
+			if self.lookahead is not None and not self.lookahead[rule].test(self.words[offset] if offset < len(self.words) else None):
+				continue
+			if self.statistics is not None:
+				self.statistics[rule].predictions += 1
+			matched = False
+			try:
+				for acc, end in self._parse_rule_at(rule.tokens, 0, offset, depth):
+					matched = True
+					if self.statistics is None:
+						yield self.intern(rule.template.consume(acc)), end
+					else:
+						self.statistics[rule].completions += 1
+						yield self.intern(self.statistics.call(rule, rule.template.consume, acc)), end
+			except:
+				raise ParseException("Error while parsing {!s}".format(rule))
+			if not matched and self.statistics is not None:
+				self.statistics[rule].backtracks += 1
+
+	def _parse_rule_at(self, tokens, n, offset, depth):
+		if n == len(tokens):
+			yield [], offset
+
+		elif is_literal(tokens[n]):
+			if offset < len(self.words) and tokens[n].test(self.words[offset]):
+				for resolution, end in self._parse_rule_at(tokens, n + 1, offset + 1, depth):
+					yield [tokens[n].consume(self.words[offset])] + resolution, end
+		else:
+			for resolution, middle in self._parse_at(tokens[n], offset, depth + 1):
+				for continuation, end in self._parse_rule_at(tokens, n + 1, middle, depth):
+					yield [resolution] + continuation, end
+
+	@unique_generator
 	def reverse(self, rule_name, tree):
-		debug("reverse {!r} {!r}".format(rule_name, tree))
+		"""
+		Realisations of the tree, each only once. Those of the parts of the
+		tree are remembered as they are produced (see shared), so a part that
+		occurs more than once in the tree is only realised once, and the first
+		realisation does not wait for all the others.
+		"""
+		return self._reverse_rule(rule_name, tree, dict())
+
+	def _reverse_rule(self, rule_name, tree, memo):
+		debug("reverse {!r} {!r}", rule_name, tree)
 		for rule in self.rules[rule_name]:
 			try:
 				flat = rule.template.reverse(tree)
-				debug('<{}>.reverse({!r}) returned true, continuing with {!r}'.format(rule_name, rule, flat))
-				yield from self._reverse(rule.tokens, flat)
+				debug('<{}>.reverse({!r}) returned true, continuing with {!r}', rule_name, rule, flat)
+				yield from self._reverse(rule.tokens, flat, memo)
 			except NoMatchException as e:
-				debug('<{}>.reverse({!r}) failed because {}'.format(rule_name, rule, e))
-
-	def _reverse(self, tokens, flat):
-		assert isinstance(flat, list)
-		debug("_reverse {!r} {!r}".format(tokens, flat))
-		if len(tokens) == 0:
-			if len(flat) == 0:
+				debug('<{}>.reverse({!r}) failed because {}', rule_name, rule, e)
+
+	def _realisations(self, rule_name, tree, memo):
+		key = (rule_name, frozen(tree))
+		if key not in memo:
+			# A rule that realises the same tree again only gets what was
+			# produced so far, as shared ends reading it from within itself.
+			memo[key] = shared(unique(self._reverse_rule(rule_name, tree, memo)))
+		return memo[key]
+
+	def _reverse(self, tokens, flat, memo, n = 0):
+		assert isinstance(flat, bindings)
+		if DEBUG: # Not even slicing the tokens otherwise
+			debug("_reverse {!r} {!r}", tokens[n:], flat)
+		if n == len(tokens):
+			if len(flat) <= n:
 				yield []
 			else:
 				raise Exception('Well I did not expect this case? Should I yield nothing now?')
 
-		elif is_literal(tokens[0]):
+		elif is_literal(tokens[n]):
 			try:
-				resolution = tokens[0].reverse(flat[0] if len(flat) > 0 else None)
-				for continuation in self._reverse(tokens[1:], flat[1:]):
+				resolution = tokens[n].reverse(flat[n])
+				for continuation in self._reverse(tokens, flat, memo, n + 1):
 					yield [resolution] + continuation
 			except NoMatchException:
 				pass
 		
 		else:
-			for resolution in self.reverse(tokens[0], flat[0]):
-				for continuation in self._reverse(tokens[1:], flat[1:]):
+			for resolution in self._realisations(tokens[n], flat[n], memo):
+				for continuation in self._reverse(tokens, flat, memo, n + 1):
 					yield resolution + continuation
 
 
@@ -770,6 +1138,36 @@ def test_sparselist():
 	print("{}({!r})".format(type(x[1:]), x[1:]))
 
 
+def test_bindings():
+	a = bindings(0, 'A', bindings(2, 'C'))
+	assert list(a) == ['A', None, 'C']
+
+	# The union pads with None, and does not change either side
+	b = bindings(4, 'E')
+	assert list(a | b) == ['A', None, 'C', None, 'E']
+	assert list(b | a) == ['A', None, 'C', None, 'E']
+	assert list(a) == ['A', None, 'C'] and list(b) == [None, None, None, None, 'E']
+	assert (a | bindings()) is a and (bindings() | a) is a
+
+	# Setting an index again is fine if it is to an equal value, or None
+	assert list(a | bindings(0, 'A')) == ['A', None, 'C']
+	assert list(a | bindings(0, None)) == ['A', None, 'C']
+	try:
+		a | bindings(0, 'B')
+		assert False, 'no error'
+	except Exception as e:
+		assert 'overwrite' in str(e)
+
+	# Sparseobjects at the same index are merged, unless they set the same key
+	c = bindings(1, sparseobject(x=1)) | bindings(1, sparseobject(y=2))
+	assert vars(c[1]) == dict(x=1, y=2)
+	try:
+		c | bindings(1, sparseobject(x=3))
+		assert False, 'no error'
+	except Exception as e:
+		assert 'overwrite' in str(e)
+
+
 def test_boxes_and_arrows():
 	rules = ruleset([
 		rule('extended_claims',
@@ -885,6 +1283,88 @@ def test_reverse_nesting():
 
 
 
+def test_packrat_and_lookahead():
+	class claim(NamedTuple):
+		id: str
+
+	class argument(NamedTuple):
+		claim: 'claim'
+		support: Optional['argument']
+		attack: Optional['argument']
+
+	class word(terminal):
+		def test(self, word):
+			return word not in ('because', 'except', 'and')
+
+	nullable = ruleset([
+		rule('argument',
+			['claim', 'support', 'attack'],
+			template(argument, claim=slot(0), support=slot(1), attack=slot(2))),
+		rule('claim', [word()], template(claim, id=slot(0))),
+		rule('claim', [word(), l('and'), 'claim'], template(claim, id=slot(0))),
+		rule('support', [], empty()),
+		rule('support', [l('because'), 'argument'], slot(1)),
+		rule('attack', [], empty()),
+		rule('attack', [l('except'), 'argument'], slot(1)),
+	])
+
+	sentences = [
+		'A',
+		'A because B',
+		'A and B because C',
+		'A because B except C',
+		'A because B because C except D',
+		'A except B because C and D',
+		'because A',
+		'A because',
+		'',
+	]
+
+	for sentence in sentences:
+		words = sentence.split(' ') if sentence else []
+		parses = [repr(list(Parser(nullable, packrat=packrat, lookahead=lookahead).parse('argument', words)))
+			for packrat in (False, True) for lookahead in (False, True)]
+		assert len(set(parses)) == 1, sentence
+
+	# Packrat does not recurse forever on left recursion, but only finds the
+	# derivations that do not start with the same name again.
+	left = ruleset([
+		rule('list', ['list', l('x')], tlist(head=slot(1), tail=slot(0))),
+		rule('list', [l('x')], tlist(head=slot(0))),
+	])
+	assert len(list(Parser(left, packrat=True).parse('list', ['x']))) == 1
+	assert len(list(Parser(left, packrat=True).parse('list', ['x', 'x']))) == 0
+
+
+def test_reverse_lazily():
+	class Node(NamedTuple):
+		inner: Optional['Node']
+
+	rules = ruleset([
+		rule('node', [l('x'), 'node'], template(Node, inner=slot(1))),
+		rule('node', [l('y'), 'node'], template(Node, inner=slot(1))),
+		rule('node', [l('end')], template(Node, inner=None)),
+	])
+
+	produced = [0]
+
+	class CountingParser(Parser):
+		def _reverse_rule(self, rule_name, tree, memo):
+			for realisation in Parser._reverse_rule(self, rule_name, tree, memo):
+				produced[0] += 1
+				yield realisation
+
+	parser = CountingParser(rules)
+	depth = 16
+	[tree] = parser.parse('node', ['x'] * depth + ['end'])
+
+	# The tree has 2 ** 16 realisations, but the first one only takes one of each part
+	first = next(parser.reverse('node', tree))
+	assert first == ['x'] * depth + ['end']
+	assert produced[0] <= depth + 1, produced[0]
+	assert len(list(islice(parser.reverse('node', tree), 50))) == 50
+
+
 if __name__ == '__main__':
 	DEBUG=False
 	# test_list()
@@ -895,7 +1375,10 @@ if __name__ == '__main__':
 	# test_generate()
 	# test_boxes_and_arrows()
 	# test_sparselist()
+	# test_bindings()
 	test_reverse_nesting()
+	# test_reverse_lazily()
+	# test_packrat_and_lookahead()
 
 
 # for n, parsed in enumerate(parse(rules['extended_claim'][0], words)):
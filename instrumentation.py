@@ -0,0 +1,61 @@
+"""
+Counters that tell which rules make a sentence slow, shared by the Earley
+parser (parser.Parser), the recursive descent parser (hasl2.parser.Parser)
+and the left corner parser (nlpg_lc.Parse). Each of them takes an optional
+Statistics and only counts when it got one, so without it all that is left
+is a check for None.
+
+Usage:
+    statistics = Statistics()
+    parser.Parser(grammar, 'sentences', statistics=statistics).parse(tokens)
+    pprint(statistics.report())
+"""
+import time
+from typing import Any, Callable, Dict, List
+
+
+class RuleStatistics:
+    __slots__ = ('predictions', 'completions', 'rejections', 'backtracks', 'time')
+
+    def __init__(self) -> None:
+        self.predictions = 0  # Times the rule was predicted, or tried
+        self.completions = 0  # Times the rule was completed
+        self.rejections = 0  # Times its callback rejected a derivation
+        self.backtracks = 0  # Times trying the rule led nowhere
+        self.time = 0.0  # Seconds spent in its callback
+
+    def report(self) -> Dict[str, Any]:
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+class Statistics:
+    def __init__(self) -> None:
+        self.rules = dict()  # type: Dict[Any, RuleStatistics]
+        self.parses = []  # type: List[Dict[str, int]]
+
+    def __getitem__(self, rule: Any) -> RuleStatistics:
+        try:
+            return self.rules[rule]
+        except KeyError:
+            self.rules[rule] = RuleStatistics()
+            return self.rules[rule]
+
+    def call(self, rule: Any, callback: Callable, *args) -> Any:
+        """Calls the callback of the rule, and adds the time it took to the rule"""
+        start = time.perf_counter()
+        try:
+            return callback(*args)
+        finally:
+            self[rule].time += time.perf_counter() - start
+
+    def parsed(self, **sizes: int) -> None:
+        """Records the size of the chart or stack (whichever the parser has) of a parse"""
+        self.parses.append(sizes)
+
+    def report(self) -> Dict[str, Any]:
+        """The counts per rule, those that took longest first, and the sizes of each parse"""
+        rules = sorted(self.rules.items(), key=lambda item: (item[1].time, item[1].completions, item[1].predictions), reverse=True)
+        return {
+            'rules': [dict(rule=str(rule), **statistics.report()) for rule, statistics in rules],
+            'parses': list(self.parses)
+        }
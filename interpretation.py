@@ -51,3 +51,7 @@ class Expression(Literal):
 
     def __repr__(self) -> str:
         return "/{}/".format(self.expression.pattern)
+
+    @property
+    def key(self):
+        return (type(self), self.expression.pattern)
@@ -1,7 +1,8 @@
 from typing import List, Dict, Any, Iterator, NamedTuple, Optional
-from nlpg import Parser, rule, terminal, l, slot
+from hasl2.parser import Parser, rule, terminal, l, slot
 from pprint import pprint
 from collections import defaultdict
+from instrumentation import Statistics
 
 # https://github.com/ssarkar2/LeftCornerParser/blob/master/LCParser.py
 
@@ -143,15 +144,23 @@ class Config(NamedTuple):
 
 
 class Parse(object):
-	def __init__(self, rules: List[rule], words: List[Any], goal: str):
+	def __init__(self, rules: List[rule], words: List[Any], goal: str, statistics: Optional[Statistics] = None):
+		"""
+		Given a Statistics, the parse counts per rule how often it was
+		predicted, completed and led to a dead end, and the time its template
+		took, and records how large the chart and the stacks grew.
+		"""
 		self.rules = remove_embedded_tokens(rules)
 		self.words = list(words)
 		self.goal = goal
 		self.nullables = find_nullables(self.rules)
+		self.statistics = statistics
 
 	def __iter__(self):
 		chart = [Config([], 0)]
 		self.counter = 0
+		largest_chart = 0
+		deepest_stack = 0
 		
 		while len(chart) > 0:
 			config = chart.pop()
@@ -165,6 +174,14 @@ class Parse(object):
 				configs = list(self.step(config))
 				chart.extend(configs)
 				self.counter += len(configs)
+				if self.statistics is not None:
+					largest_chart = max(largest_chart, len(chart))
+					deepest_stack = max(deepest_stack, len(config.stack))
+					if len(configs) == 0 and len(config.stack) > 0:
+						self.statistics[config.stack[-1].rule].backtracks += 1
+
+		if self.statistics is not None:
+			self.statistics.parsed(tokens=len(self.words), chart=largest_chart, stack=deepest_stack, paths=self.counter)
 
 	def step(self, config: Config):
 		yield from self._advance(config)
@@ -180,7 +197,11 @@ class Parse(object):
 		"""
 		try:
 			if len(rule.tokens) == len(match):
-				match = rule.template.consume(match)
+				if self.statistics is None:
+					match = rule.template.consume(match)
+				else:
+					self.statistics[rule].completions += 1
+					match = self.statistics.call(rule, rule.template.consume, match)
 		except:
 			raise Exception("Error while {!r} tries to eat {!r}".format(rule, match))
 		return match
@@ -189,6 +210,8 @@ class Parse(object):
 		if config.index < len(self.words) and (len(config.stack) == 0 or not config.stack[-1].complete):
 			word = self.words[config.index]
 			for rule in self._find_rules(word):
+				if self.statistics is not None:
+					self.statistics[rule].completions += 1
 				match = rule.tokens[0].consume(word)
 				yield Config(config.stack + [Frame(rule, 1, match)], config.index + 1)
 
@@ -200,6 +223,8 @@ class Parse(object):
 		if len(config.stack) > 0:
 			if config.stack[-1].complete:
 				for rule in self._find_left_corner(config.stack[-1].rule):
+					if self.statistics is not None:
+						self.statistics[rule].predictions += 1
 					match = self._eat(rule, [config.stack[-1].match])
 					yield Config(config.stack[0:-1] + [Frame(rule, 1, match)], config.index)
 
@@ -249,13 +274,17 @@ class Parse(object):
 
 
 class LCParser(Parser):
+	def __init__(self, rules, statistics: Optional[Statistics] = None):
+		super().__init__(rules)
+		self.statistics = statistics
+
 	def parse(self, rule_name, words):
-		return Parse(self.rules, words, rule_name)
+		return Parse(self.rules, words, rule_name, self.statistics)
 
 
 if __name__ == '__main__':
-	import nlpg
-	from nlpg import ruleset, rule, tlist, template, l, slot, empty
+	import hasl2.parser as nlpg
+	from hasl2.parser import ruleset, rule, tlist, template, l, slot, empty
 	from pprint import pprint
 
 	class claim(NamedTuple):
@@ -361,8 +390,8 @@ if __name__ == '__main__':
 	words = sentence.split(' ')
 
 	from timeit import timeit
-	print("LC Parser: {}".format(timeit('list(rd_parser.parse(start, words))', number=100, globals={'rd_parser': rd_parser, 'start': start, 'words': words})))
-	print("RD Parser: {}".format(timeit('list(lc_parser.parse(start, words))', number=100, globals={'lc_parser': lc_parser, 'start': start, 'words': words})))
+	print("RD Parser: {}".format(timeit('list(rd_parser.parse(start, words))', number=100, globals={'rd_parser': rd_parser, 'start': start, 'words': words})))
+	print("LC Parser: {}".format(timeit('list(lc_parser.parse(start, words))', number=100, globals={'lc_parser': lc_parser, 'start': start, 'words': words})))
 
 	parser = lc_parser
 
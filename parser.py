@@ -1,17 +1,22 @@
 #!/usr/bin/env python3
 
 # Based on https://github.com/Hardmath123/nearley/blob/master/lib/nearley.js
+import itertools
 import operator
-from typing import List, Optional, Any, Callable, Union, cast
-from collections import OrderedDict
+from typing import List, Dict, Set, FrozenSet, Tuple, Sequence, Iterable, Iterator, Optional, Any, Callable, Union, cast
+from collections import OrderedDict, defaultdict
+from array import array
 import codecs
 import functools
+import heapq
 import re
 import inspect
 import os
 
 import traceback
 
+from instrumentation import Statistics
+
 def log(line: str) -> None:
     pass
 
@@ -32,6 +37,10 @@ def passthru(state, data):
 
 
 class Continue(Exception):
+    """
+    Raised by a callback to reject a derivation. Returning Parser.FAIL does
+    the same without the cost of an exception, and is what the parser uses.
+    """
     pass
 
 
@@ -40,6 +49,7 @@ class ParseError(Exception):
         self.position = position
         self.token = token
         self.sentence = sentence
+        self.expected = expected
         super().__init__("No possible parse for '{}' (at position {}){}".format(token, position + 1,
             ", expected:\n  " + "\n  | ".join(expected) if expected is not None else ""))
 
@@ -128,8 +138,18 @@ test_span()
 
 class Symbol:
     def test(self, literal: str, position: int, state: 'State') -> bool:
+        """
+        Whether the token at this position matches. The parser tests each
+        symbol only once per position, for the first state that expects it,
+        so the outcome should not depend on the state.
+        """
         raise NotImplementedError("Symbol.test is abstract")
 
+    @property
+    def key(self) -> Any:
+        """Symbols with the same key test the same, so they can share the outcome"""
+        return id(self)
+
     def finish(self, literal: str, position: int, state: 'State'):
         return Span(literal, position, position + 1)
 
@@ -141,6 +161,10 @@ class Literal(Symbol):
     def test(self, literal: str, position: int, state: 'State') -> bool:
         return self.literal == literal
 
+    @property
+    def key(self) -> Any:
+        return (type(self), self.literal)
+
     def __repr__(self) -> str:
         return "\"{}\"".format(self.literal)
 
@@ -152,14 +176,21 @@ class RuleRef(Symbol):
     def test(self, literal: str, position: int, state: 'State') -> bool:
         return False
 
+    @property
+    def key(self) -> Any:
+        return (type(self), self.name)
+
     def __repr__(self, with_cursor_at: int = None) -> str:
         return "{}".format(self.name)
 
 
 class Rule:
+    ids = itertools.count()
+
     def __init__(self, name: str, symbols: List[Symbol], callback: Optional[Callable[[Any, int], Any]] = None, file=None, line=None) -> None:
         self.name = name
         self.symbols = symbols
+        self.id = next(Rule.ids)
         if callback is not None:
             self.callback = callback
         else:
@@ -168,10 +199,12 @@ class Rule:
             self.file = file
             self.line = line
         else:
+            # Only what the frame already knows. inspect.getframeinfo() would
+            # read the source from disk for every rule, which made building a
+            # grammar slow; tooltip reads the rest when it is asked for.
             previous_frame = inspect.currentframe().f_back
-            (filename, line_number, function_name, lines, index) = inspect.getframeinfo(previous_frame)
-            self.file = filename
-            self.line = line_number
+            self.file = previous_frame.f_code.co_filename
+            self.line = previous_frame.f_lineno
         
     def __repr__(self, with_cursor_at: int = None) -> str:
         if with_cursor_at is not None:
@@ -182,6 +215,16 @@ class Rule:
         else:
             return "{} ⇒ {}".format(self.name, " ".join(map(repr, self.symbols)))
 
+    @property
+    def signature(self) -> tuple:
+        """
+        Rules with the same signature are the same rule, even if they are
+        different objects: they have the same name, symbols that test the same
+        (see Symbol.key) and the same callback. Rules that only look the same
+        can still differ in what their symbols accept or their callback makes.
+        """
+        return (self.name, tuple(symbol.key for symbol in self.symbols), self.callback)
+
     @property
     def tooltip(self):
         return "{file}: {line}\n{repr}".format(
@@ -193,16 +236,13 @@ class Rule:
         return self
 
     def finish(self, state: 'State', data: List[Any]) -> Any:
-        log("!!! Finishing {} with data {} and reference {}!".format(self.name, state.data, state.reference))
+        log("!!! Finishing {} with data {}!".format(self.name, data))
         try:
             return self.callback(state, data)
+        except Continue:
+            return Parser.FAIL
         except Exception as e:
-            if isinstance(e, Continue):
-                print("1111111")
-                raise e
-            else:
-                print("222222")
-                raise Exception('Error while trying to finish the rule {!r}'.format(self)) from e
+            raise Exception('Error while trying to finish the rule {!r}'.format(self)) from e
 
 
 class RuleInstance:
@@ -217,25 +257,142 @@ class RuleInstance:
             return "[{}: (empty)]".format(self.rule.name)
 
 
+class Trace:
+    """
+    The steps that led to a state, as a linked structure that is shared with
+    the states it was derived from. Each step is recorded as a small tuple of
+    (event, rule, position in the rule, ...) and only turned into text when
+    someone asks for it.
+    """
+    __slots__ = ('previous', 'event', 'child')
+
+    # Tracing modes of the parser
+    OFF = 'off'
+    COMPACT = 'compact'
+    FULL = 'full'
+
+    # Events
+    TERMINAL = 'terminal'
+    NON_TERMINAL = 'non-terminal'
+    FINISH = 'finish'
+
+    def __init__(self, previous: Optional['Trace'], event: Union[tuple, str], child: Optional['Trace'] = None) -> None:
+        self.previous = previous
+        self.event = event
+        self.child = child
+
+    def __iter__(self):
+        """Events in the order in which they happened: previous, event, child."""
+        stack = [(self, False)]
+        while len(stack) > 0:
+            node, visited = stack.pop()
+            if node is None:
+                continue
+            elif visited:
+                yield node.event
+                stack.append((node.child, False))
+            else:
+                stack.append((node, True))
+                stack.append((node.previous, False))
+
+    def render(self) -> List[str]:
+        return [self.format(event) for event in self]
+
+    @classmethod
+    def record(cls, tracing: str, *event) -> Union[tuple, str, None]:
+        if tracing == cls.OFF:
+            return None
+        elif tracing == cls.FULL:
+            return cls.format(event)
+        else:
+            return event
+
+    @classmethod
+    def format(cls, event: Union[tuple, str]) -> str:
+        if isinstance(event, str):
+            return event
+        elif event[0] == cls.TERMINAL:
+            _, rule, expect, token_pos, token = event
+            return 'Consume terminal {!r}({}) with {!r}'.format(token, token_pos, rule.symbols[expect])
+        elif event[0] == cls.NON_TERMINAL:
+            _, rule, expect, consumed = event
+            return '{!r}: Consume non-terminal {!r}'.format(rule.__repr__(expect), consumed)
+        elif event[0] == cls.FINISH:
+            _, rule = event
+            return 'Finish rule {!r}'.format(rule)
+        else:
+            raise ValueError('Unknown trace event {!r}'.format(event))
+
+
 class State:
+    """
+    A state only holds what it added to the state it advanced from: the token
+    it consumed (if any), the value of the symbol it moved the dot over and
+    the completed state or empty derivation it took that value from. All
+    values and consumed input are found by walking back along previous, which
+    only happens once the rule completes, so advancing copies nothing.
+    """
+    __slots__ = ('rule', 'expect', 'reference', 'token', 'value', 'result', 'trace', 'previous', 'child', 'packed')
+
+    PENDING = object()  # The result of a state whose rule has not been finished
+
     def __init__(self, rule: Rule, expect: int, reference: int) -> None:
         assert len(rule.symbols) > 0
         self.rule = rule
         self.expect = expect
         self.reference = reference
-        self.inp = []
-        self.data = []  # type: List[Any]
-        self.trace = []
-        self.error = None
+        self.token = None  # type: Any
+        self.value = None  # type: Any
+        self.result = State.PENDING  # type: Any
+        self.trace = None  # type: Optional[Trace]
+        self.previous = None  # type: Optional[State]
+        self.child = None  # type: Union[State, EmptyDerivation, int, LeoChild, None]
+        self.packed = None  # type: Optional[List[State]]
 
     def __repr__(self) -> str:
         return "{rule}, from: {ref} (data:{data!r})".format(rule=self.rule.__repr__(self.expect), ref=self.reference, data=self.data)
 
-    def __eq__(self, other) -> bool:
-        return self.rule is other.rule \
-            and self.expect == other.expect \
-            and self.reference == other.reference \
-            and self.trace == other.trace
+    @property
+    def item(self) -> tuple:
+        """The Earley item this state is, regardless of how it was derived."""
+        return (self.rule.id, self.expect, self.reference)
+
+    @property
+    def derivation(self) -> tuple:
+        """
+        The Earley item plus the state it advanced from and the completed state
+        (or empty rule) it consumed to do so. Only states that made it into
+        the chart get advanced, so comparing those by identity is enough to
+        tell two derivations apart. A predicted state was not derived from
+        anything, so that is just its item.
+        """
+        if self.previous is None:
+            return (self.rule.id, self.expect, self.reference)
+        return (self.rule.id, self.expect, self.reference, self.previous, self.child)
+
+    @property
+    def data(self) -> Any:
+        """The values of the symbols before the dot, or once the rule is finished, what its callback made of them"""
+        return self.result if self.result is not State.PENDING else self.values()
+
+    def chain(self) -> List['State']:
+        """The states this state advanced through, from the first symbol on"""
+        states = []
+        state = self
+        while state.previous is not None:
+            states.append(state)
+            state = state.previous
+        states.reverse()
+        return states
+
+    def values(self) -> List[Any]:
+        return [state.value for state in self.chain()]
+
+    @property
+    def inp(self) -> List[Any]:
+        """The tokens and completed states consumed so far"""
+        return [state.child if isinstance(state.child, State) else state.token
+                for state in self.chain() if not isinstance(state.child, EmptyDerivation)]
 
     @property
     def tree(self):
@@ -247,116 +404,788 @@ class State:
         }
 
 
-    def nextState(self, inp, data, trace) -> 'State':
+    @property
+    def alternatives(self) -> List['State']:
+        """This state and the other derivations of its item packed into it (forest mode)"""
+        return [self] + self.packed if self.packed is not None else [self]
+
+    def advance(self, child: Union['State', 'EmptyDerivation', int, 'LeoChild']) -> 'State':
+        """
+        Next state without any semantic data, for forest mode. The child is
+        the completed state, the empty derivation or the position of the
+        token that was consumed.
+        """
         state = State(self.rule, self.expect + 1, self.reference)
-        state.inp = self.inp + inp
-        state.data = self.data + [data]
-        state.trace = trace + self.trace
+        state.previous = self
+        state.child = child
         return state
 
-    def consumeTerminal(self, inp: str, token_pos: int) -> Optional['State']:
+    def nextState(self, token, value, event) -> 'State':
+        state = State(self.rule, self.expect + 1, self.reference)
+        state.previous = self
+        state.token = token
+        state.value = value
+        state.trace = Trace(self.trace, event) if event is not None else self.trace
+        return state
+
+    def consumeTerminal(self, inp: str, token_pos: int, tracing: str = Trace.FULL) -> Optional['State']:
         log("consumeTerminal {} using {} expecting {}".format(inp, self.rule, self.rule.symbols[self.expect] if len(
             self.rule.symbols) > self.expect else '>END<'))
         if len(self.rule.symbols) > self.expect and self.rule.symbols[self.expect].test(inp, token_pos, self):
             log("Terminal consumed")
-            try:
-                return self.nextState([inp], self.rule.symbols[self.expect].finish(inp, token_pos, self), ['Consume terminal {!r}({}) with {!r}'.format(inp, token_pos, self.rule.symbols[self.expect])])
-            except Exception as e:
-                raise Exception('Exception while trying to consume {!r} with {!r}'.format(inp, self.rule.symbols[self.expect])) from e
+            return self.scan(inp, token_pos, tracing)
         else:
             return None
 
-    def consumeNonTerminal(self, inp: Rule) -> Optional['State']:
+    def scan(self, inp: str, token_pos: int, tracing: str = Trace.FULL) -> 'State':
+        """consumeTerminal for a token that is already known to match"""
+        try:
+            return self.nextState(inp, self.rule.symbols[self.expect].finish(inp, token_pos, self), Trace.record(tracing, Trace.TERMINAL, self.rule, self.expect, token_pos, inp))
+        except Exception as e:
+            raise Exception('Exception while trying to consume {!r} with {!r}'.format(inp, self.rule.symbols[self.expect])) from e
+
+    def consumeNonTerminal(self, inp: Rule, tracing: str = Trace.FULL) -> Optional['State']:
         assert isinstance(inp, Rule)
         if len(self.rule.symbols) > self.expect \
                 and isinstance(self.rule.symbols[self.expect], RuleRef) \
                 and self.rule.symbols[self.expect].name == inp.name:
-            return self.nextState([], inp.consume(self), ['{!r}: Consume non-terminal {!r}'.format(self.rule.__repr__(self.expect), inp)])
+            return self.nextState(None, inp.consume(self), Trace.record(tracing, Trace.NON_TERMINAL, self.rule, self.expect, inp))
         else:
             return None
 
-    def process(self, location, table: List[List['State']], rules: List[Rule], added_rules: List[Rule]) -> None:
-        if self.expect == len(self.rule.symbols):
-            # We have a completed rule
-            self.data = self.rule.finish(self, self.data)
-            self.trace.insert(0, 'Finish rule {!r}'.format(self.rule))
-
-            w = 0
-            # We need a while here because the empty rule will modify table[reference] when location == reference
-            while w < len(table[self.reference]):
-                state = table[self.reference][w]
-                next_state = state.consumeNonTerminal(self.rule)
-                if next_state is not None:
-                    next_state.data[-1] = self.data
-                    next_state.inp.append(self)
-                    next_state.trace = self.trace + next_state.trace
-                    table[location].append(next_state)
+    def complete(self, location: int, table: List['Column'], parser: 'Parser') -> None:
+        column = table[location]
+
+        if parser.statistics is not None:
+            parser.statistics[self.rule].completions += 1
+
+        # We have a completed rule. In forest mode the callback only runs
+        # once the derivations are enumerated.
+        if not parser.forest:
+            if parser.statistics is None:
+                self.result = self.rule.finish(self, self.values())
+            else:
+                self.result = parser.statistics.call(self.rule, self.rule.finish, self, self.values())
+            if self.result is Parser.FAIL:
+                parser.reject(column, self)
+                return
+            if parser.tracing != Trace.OFF:
+                self.trace = Trace(self.trace, Trace.record(parser.tracing, Trace.FINISH, self.rule))
+
+        if self.reference == location:
+            # Spans nothing, so it is one of the empty derivations that
+            # predict() already used to skip over this name.
+            return
+        elif parser.forest and parser.leo:
+            # If this completion only leads to a chain of completions, as
+            # with right recursion, skip straight to the top of the chain.
+            leo = parser.leoItem(self.reference, self.rule.name)
+            if leo is not None and leo.above is not None:
+                column.add(leo.top.advance(LeoChild(leo, self)))
+                return
+
+        # Only the states in the reference column that are waiting for this
+        # rule's name can advance. We need a while here because the empty
+        # rule will add to that list when location == reference.
+        origin = table[self.reference]
+        waiting = origin.waiting.get(self.rule.name, ())
+        w = 0
+        while w < len(waiting):
+            state = origin.state(waiting[w])
+            if parser.forest:
+                column.add(state.advance(self))
                 w += 1
+                continue
+            next_state = state.consumeNonTerminal(self.rule, parser.tracing)
+            if next_state is not None:
+                next_state.value = self.result
+                next_state.child = self
+                if next_state.trace is not None:
+                    next_state.trace.child = self.trace
+                column.add(next_state)
+            w += 1
 
-                # --- The comment below is OUTDATED. It's left so that future
-                # editors know not to try and do that.
+            # --- The comment below is OUTDATED. It's left so that future
+            # editors know not to try and do that.
 
-                # Remove this rule from "addedRules" so that another one can be
-                # added if some future added rule requires it.
-                # Note: I can be optimized by someone clever and not-lazy. Somehow
-                # queue rules so that everything that this completion "spawns" can
-                # affect the rest of the rules yet-to-be-added-to-the-table.
-                # Maybe.
+            # Remove this rule from "addedRules" so that another one can be
+            # added if some future added rule requires it.
+            # Note: I can be optimized by someone clever and not-lazy. Somehow
+            # queue rules so that everything that this completion "spawns" can
+            # affect the rest of the rules yet-to-be-added-to-the-table.
+            # Maybe.
 
-                # I repeat, this is a *bad* idea.
+            # I repeat, this is a *bad* idea.
 
-                # var i = addedRules.indexOf(this.rule);
-                # if (i !== -1) {
-                #     addedRules.splice(i, 1);
-                # }
-        else:
-            # in case I missed an older nullable's sweep, update yourself. See
-            # above context for why this makes sense
-            ind = table[location].index(self)
-            for i in range(ind):
-                state = table[location][i]
-                if len(state.rule.symbols) == state.expect and state.reference == location:
-                    raise NotImplementedError("Code should not reach this place because we don't do nullables")
-                    x = self.consumeNonTerminal(state.rule)
-                    if x is not None:
-                        x.data[-1] = state.data
-                        x.trace = state.trace + x.trace
-                        table[location].append(x)
-
-            # I'm not done, but I can predict something
-            expected_symbol = self.rule.symbols[self.expect]
-
-            if isinstance(expected_symbol, RuleRef):
-                for rule in rules:
-                    if rule.name == expected_symbol.name and rule not in added_rules:
-                        # Make a note that you've added it already, and don't need to
-                        # add it again; otherwise left recursive rules are going to go
-                        # into an infinite loop by adding themselves over and over
-                        # again.
-
-                        # If it's the null rule, however, you don't do this because it
-                        # affects the current table row, so you might need it to be
-                        # called again later. Instead, I just insert a copy whose
-                        # state has been advanced one position (since that's all the
-                        # null rule means anyway)
-                        if len(rule.symbols) > 0:
-                            added_rules.append(rule)
-                            table[location].append(State(rule, 0, location))
-                        else:
-                            # Empty rule, this is special
-                            copy = self.consumeNonTerminal(rule)
-                            copy.data[-1] = rule.finish(self, [])
-                            table[location].append(copy)
+            # var i = addedRules.indexOf(this.rule);
+            # if (i !== -1) {
+            #     addedRules.splice(i, 1);
+            # }
+
+
+class EmptyDerivation:
+    """
+    One way a nullable non-terminal derives nothing at all, by the given rule
+    and the empty derivations of its symbols. Its data is the same wherever
+    it occurs, so it is only computed once (without a state) per parser.
+    """
+    __slots__ = ('rule', 'children', '_data')
+
+    def __init__(self, rule: Rule, children: List['EmptyDerivation']) -> None:
+        self.rule = rule
+        self.children = children
+        self._data = self  # Not computed yet
+
+    @property
+    def data(self) -> Any:
+        """Parser.FAIL if a callback rejects it"""
+        if self._data is self:
+            data = [child.data for child in self.children]
+            self._data = Parser.FAIL if any(item is Parser.FAIL for item in data) else self.rule.finish(None, data)
+        return self._data
+
+
+class LeoItem:
+    """
+    Leo's transitive item: the only state in a column that waits for a name
+    would be complete once it consumes that name, and so on for the state
+    waiting for that, up to the top state. A completed rule of that name can
+    then advance the top state straight away, which keeps right recursion
+    linear.
+    """
+    __slots__ = ('state', 'above', 'top')
+
+    def __init__(self, state: 'State', above: Optional['LeoItem']) -> None:
+        self.state = state
+        self.above = above
+        self.top = above.top if above is not None else state  # type: State
+
+
+class LeoChild:
+    """
+    What the top state of a Leo item consumed. The states in between are
+    only made when the forest is enumerated.
+    """
+    __slots__ = ('leo', 'completed', '_state')
+
+    def __init__(self, leo: LeoItem, completed: State) -> None:
+        self.leo = leo
+        self.completed = completed
+        self._state = None  # type: Optional[State]
+
+    @property
+    def state(self) -> State:
+        if self._state is None:
+            state = self.completed
+            leo = self.leo
+            while leo.above is not None:
+                state = leo.state.advance(state)
+                leo = leo.above
+            self._state = state
+        return self._state
+
+
+class Column:
+    """
+    All states at one position in the chart. Each state is kept as its rule
+    id, dot and origin in three parallel arrays. Only the states that carry
+    more than that, i.e. data, a trace and how they were derived, have a
+    State object, which lives in a side table. A predicted state only gets
+    one once it is advanced, and most of them never are.
+
+    Next to the states themselves the column keeps track of which states are
+    waiting for which non-terminal, so that a completed rule only has to look
+    at the states it can actually advance. Likewise the states expecting a
+    terminal are grouped by that symbol (or by the literal itself) so each
+    symbol is only tested once against the next token.
+
+    States are deduplicated on the way in using the key function, e.g.
+    State.item or State.derivation. When packing, a duplicate is not dropped
+    but kept as an alternative derivation of the state already in the column.
+    """
+
+    def __init__(self, rules: Dict[int, Rule], key: Callable[[State], tuple], pack: bool = False) -> None:
+        self.rules = rules
+        self.key = key
+        self.pack = pack
+        self.ids = array('l')
+        self.dots = array('l')
+        self.origins = array('l')
+        self.states = dict()  # type: Dict[int, State]
+        self.keys = dict()  # type: Dict[tuple, int]
+        self.waiting = dict()  # type: Dict[str, array]
+        self.literals = dict()  # type: Dict[str, array]
+        self.terminals = dict()  # type: Dict[Any, Tuple[Symbol, array]]
+        self.predicted = set()  # type: Set[str]
+        self.leo = dict()  # type: Dict[str, Optional[LeoItem]]
+
+    def __len__(self) -> int:
+        return len(self.dots)
+
+    def __iter__(self):
+        return (self.state(index) for index in range(len(self)))
+
+    def rule(self, index: int) -> Rule:
+        state = self.states.get(index)
+        return state.rule if state is not None else self.rules[self.ids[index]]
+
+    def state(self, index: int) -> State:
+        """The State of a state in this column, made on demand for predicted states"""
+        state = self.states.get(index)
+        if state is None:
+            state = State(self.rules[self.ids[index]], self.dots[index], self.origins[index])
+            self.states[index] = state
+        return state
+
+    def completed(self):
+        return (self.states[index] for index in range(len(self))
+                if self.dots[index] > 0 and self.dots[index] == len(self.states[index].rule.symbols))
+
+    def add(self, state: State) -> bool:
+        key = self.key(state)
+        if key in self.keys:
+            if self.pack:
+                existing = self.state(self.keys[key])
+                if existing.packed is None:
+                    existing.packed = []
+                existing.packed.append(state)
+            return False
+        self.keys[key] = len(self)
+        self.states[len(self)] = state
+        self._append(state.rule, state.expect, state.reference)
+        return True
+
+    def predict(self, rule: Rule, location: int) -> None:
+        """
+        Same as add(State(rule, 0, location)), without making the State. The
+        parser predicts each rule only once per column, so there is no need
+        to keep a key around for deduplicating these.
+        """
+        self._append(rule, 0, location)
+
+    def _append(self, rule: Rule, dot: int, origin: int) -> None:
+        index = len(self)
+        self.ids.append(rule.id)
+        self.dots.append(dot)
+        self.origins.append(origin)
+        if dot < len(rule.symbols):
+            symbol = rule.symbols[dot]
+            if isinstance(symbol, RuleRef):
+                group = self.waiting.get(symbol.name)
+                if group is None:
+                    group = self.waiting[symbol.name] = array('l')
+            elif type(symbol).test is Literal.test:
+                group = self.literals.get(symbol.literal)
+                if group is None:
+                    group = self.literals[symbol.literal] = array('l')
+            else:
+                group = self.terminals.setdefault(symbol.key, (symbol, array('l')))[1]
+            group.append(index)
+
+    def discard(self, indices: Set[int]) -> None:
+        """
+        Stops states from being advanced any further. They stay in the column,
+        but are no longer found by completing or scanning.
+        """
+        for groups in (self.waiting, self.literals):
+            for name, group in list(groups.items()):
+                groups[name] = array('l', (index for index in group if index not in indices))
+        for key, (symbol, group) in list(self.terminals.items()):
+            group = array('l', (index for index in group if index not in indices))
+            if len(group) > 0:
+                self.terminals[key] = (symbol, group)
+            else:
+                del self.terminals[key]
+
+    def scan(self, token: Any, token_pos: int) -> List[State]:
+        """The states that can consume the token, in the order they were added"""
+        groups = []
+        if isinstance(token, str) and token in self.literals:
+            groups.append(self.literals[token])
+        for symbol, indices in self.terminals.values():
+            if symbol.test(token, token_pos, self.state(indices[0])):
+                groups.append(indices)
+        return [self.state(index) for index in heapq.merge(*groups)]
+
+
+class Lazy:
+    """
+    A list that is filled from an iterator while it is read, so several
+    readers can share the items without producing any of them twice. Reading
+    it from within its own iterator (a cycle in the forest) ends the read.
+    """
+
+    def __init__(self, iterable) -> None:
+        self.iterator = iter(iterable)
+        self.items = []  # type: List[Any]
+        self.busy = False
+
+    def __iter__(self):
+        n = 0
+        while True:
+            if n < len(self.items):
+                yield self.items[n]
+            elif self.iterator is None or self.busy:
+                return
+            else:
+                self.busy = True
+                try:
+                    self.items.append(next(self.iterator))
+                except StopIteration:
+                    self.iterator = None
+                    return
+                finally:
+                    self.busy = False
+                yield self.items[n]
+            n += 1
+
+
+class Derivation:
+    """A completed rule as enumerated from the forest, with what it consumed."""
+    __slots__ = ('rule', 'inp')
+
+    def __init__(self, rule: Rule, inp: List[Any]) -> None:
+        self.rule = rule
+        self.inp = inp
+
+    @property
+    def tree(self):
+        return {
+            'label': self.rule.name,
+            'tooltip': self.rule.tooltip,
+            'nodes': [child.tree if isinstance(child, Derivation) else {'label': child} for child in self.inp]
+        }
+
+
+class Result(dict):
+    """
+    A parse as returned by Parser.finish(): a dict with its data, its trace
+    and its tree. Only data is there right away; trace and tree are made the
+    first time they are asked for (or the whole dict is read, e.g. when it is
+    serialized) and then kept.
+    """
+
+    def __init__(self, data: Any, trace: Callable[[], List[str]], tree: Callable[[], dict]) -> None:
+        super().__init__(data=data)
+        self.lazy = dict(trace=trace, tree=tree)  # type: Dict[str, Callable[[], Any]]
+
+    def __missing__(self, key: str) -> Any:
+        if key not in self.lazy:
+            raise KeyError(key)
+        value = self[key] = self.lazy.pop(key)()
+        return value
+
+    def materialize(self) -> 'Result':
+        for key in list(self.lazy):
+            self[key]
+        return self
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def __contains__(self, key) -> bool:
+        return key in self.lazy or super().__contains__(key)
+
+    def __iter__(self):
+        return super(Result, self.materialize()).__iter__()
+
+    def __len__(self) -> int:
+        return super().__len__() + len(self.lazy)
+
+    def __eq__(self, other) -> bool:
+        if isinstance(other, Result):
+            other.materialize()
+        return super(Result, self.materialize()).__eq__(other)
+
+    __hash__ = None  # type: ignore
+
+    def __repr__(self) -> str:
+        return super(Result, self.materialize()).__repr__()
+
+    def __reduce__(self):
+        return dict, (dict(self.materialize()),)
+
+    def keys(self):
+        return super(Result, self.materialize()).keys()
+
+    def values(self):
+        return super(Result, self.materialize()).values()
+
+    def items(self):
+        return super(Result, self.materialize()).items()
+
+    def copy(self) -> dict:
+        return dict(self.materialize())
+
+
+class Forest:
+    """
+    The shared packed parse forest that is the chart of a parser in forest
+    mode. Every item in the chart holds all the ways it was derived as
+    (previous, child) links, and the callbacks only run while walking those
+    links from the root. Each state is only derived once, however many
+    parents share it.
+    """
+
+    def __init__(self, parser: 'Parser') -> None:
+        self.parser = parser
+        self._prefixes = dict()  # type: Dict[State, Lazy]
+        self._completions = dict()  # type: Dict[State, Lazy]
+
+    @property
+    def roots(self) -> List[State]:
+        return [state for state in self.parser.table[-1].completed() if
+                state.rule.name == self.parser.start
+                and state.expect == len(state.rule.symbols)
+                and state.reference == 0]
+
+    def results(self):
+        """Lazily yields a result like Parser.finish() for each derivation that is not rejected"""
+        for root in self.roots:
+            for data, derivation in self.completions(root):
+                if data is not Parser.FAIL:
+                    yield Result(data, list, lambda derivation=derivation: derivation.tree)
+
+    def count(self) -> int:
+        """The number of derivations, without running any callbacks (and so without any rejections)"""
+        counts = dict()  # type: Dict[State, int]
+        visiting = set()  # type: Set[State]
+
+        def links(state: State):
+            for alternative in state.alternatives:
+                child = alternative.child
+                if isinstance(child, LeoChild):
+                    child = child.state
+                yield alternative.previous, child if isinstance(child, State) else None
+
+        # Depth first, without recursion as right recursive chains get deep
+        stack = list(self.roots)
+        while len(stack) > 0:
+            state = stack[-1]
+            if state in counts:
+                stack.pop()
+            elif state.expect == 0:
+                counts[state] = 1
+                stack.pop()
+            elif state not in visiting:
+                visiting.add(state)
+                for previous, child in links(state):
+                    stack.extend(dependency for dependency in (previous, child)
+                                 if dependency is not None and dependency not in counts and dependency not in visiting)
+            else:
+                # Cycles do not add derivations
+                counts[state] = sum(counts.get(previous, 0) * (counts.get(child, 0) if child is not None else 1)
+                                    for previous, child in links(state))
+                visiting.discard(state)
+                stack.pop()
+
+        return sum(counts[root] for root in self.roots)
+
+    def completions(self, state: State) -> Lazy:
+        """(data, Derivation) for each derivation of a completed state"""
+        if state not in self._completions:
+            self._completions[state] = Lazy(self._complete(state))
+        return self._completions[state]
+
+    def prefixes(self, state: State) -> Lazy:
+        """Tuples of (data, consumed) for each derivation of the symbols before the dot"""
+        if state not in self._prefixes:
+            self._prefixes[state] = Lazy(self._prefix(state))
+        return self._prefixes[state]
+
+    def _complete(self, state: State):
+        for prefix in self.prefixes(state):
+            if self.parser.statistics is None:
+                data = state.rule.finish(state, [data for data, _ in prefix])
+            else:
+                data = self.parser.statistics.call(state.rule, state.rule.finish, state, [data for data, _ in prefix])
+            if data is Parser.FAIL:
+                self.parser.rejected(state.rule)
+                continue
+            yield data, Derivation(state.rule, [consumed for _, consumed in prefix if consumed is not None])
+
+    def _prefix(self, state: State):
+        if state.expect == 0:
+            yield ()
+            return
+
+        symbol = state.rule.symbols[state.expect - 1]
+        for alternative in state.alternatives:
+            previous, child = alternative.previous, alternative.child
+            if isinstance(child, LeoChild):
+                child = child.state
+            if isinstance(child, State):
+                for prefix in self.prefixes(previous):
+                    for data, derivation in self.completions(child):
+                        yield prefix + ((data, derivation),)
+            elif isinstance(child, EmptyDerivation):
+                data = child.data
+                if data is Parser.FAIL:
+                    self.parser.rejected(child.rule)
+                    continue
+                for prefix in self.prefixes(previous):
+                    yield prefix + ((data, None),)
+            else:
+                token = self.parser.tokens[child]
+                data = symbol.finish(token, child, previous)
+                for prefix in self.prefixes(previous):
+                    yield prefix + ((data, token),)
+
+
+class Recognizer:
+    """
+    Tells whether the input is in the language, without running callbacks or
+    keeping derivations. Every dotted rule is a bit, numbered so that moving
+    the dot one symbol is a shift by one. A column is an int per origin with
+    the bits of the dotted rules started there, so scanning and completing
+    advance all matching dotted rules at once using a mask per symbol.
+    """
+    cache = dict()  # type: Dict[Tuple[Tuple[int, ...], str], Recognizer]
+
+    def __init__(self, rules: Dict[int, Rule], start: str) -> None:
+        self.start = start
+        self.lhs = []  # type: List[str] (the name of the rule of each bit)
+        self.initial = defaultdict(int)  # type: Dict[str, int] (dot at the start, per name)
+        self.finished = defaultdict(int)  # type: Dict[str, int] (dot at the end, per name)
+        self.expects = defaultdict(int)  # type: Dict[str, int] (dot before the non-terminal)
+        self.literals = defaultdict(int)  # type: Dict[str, int]
+        self.terminals = dict()  # type: Dict[Any, List[Any]] (symbol and mask per symbol key)
+
+        for rule in rules.values():
+            if len(rule.symbols) == 0:
+                continue
+            base = len(self.lhs)
+            self.lhs.extend([rule.name] * (len(rule.symbols) + 1))
+            self.initial[rule.name] |= 1 << base
+            self.finished[rule.name] |= 1 << (base + len(rule.symbols))
+            for dot, symbol in enumerate(rule.symbols):
+                bit = 1 << (base + dot)
+                if isinstance(symbol, RuleRef):
+                    self.expects[symbol.name] |= bit
+                elif type(symbol).test is Literal.test:
+                    self.literals[symbol.literal] |= bit
+                else:
+                    self.terminals.setdefault(symbol.key, [symbol, 0])[1] |= bit
+        self.final = functools.reduce(operator.or_, self.finished.values(), 0)
+
+        nullable = set()  # type: Set[str]
+        changed = True
+        while changed:
+            changed = False
+            for rule in rules.values():
+                if rule.name not in nullable \
+                        and all(isinstance(symbol, RuleRef) and symbol.name in nullable for symbol in rule.symbols):
+                    nullable.add(rule.name)
+                    changed = True
+        self.nullable = functools.reduce(operator.or_, (self.expects[name] for name in nullable), 0)
+
+        # Predicting a name also predicts the rules of every name those can start with
+        self.predictions = dict()  # type: Dict[str, int]
+        starts = {name: self.expected(self.skip(self.initial[name])) for name in self.initial}
+        for name in self.initial:
+            seen = {name}
+            todo = [name]
+            for current in todo:
+                for other in starts.get(current, ()):
+                    if other not in seen:
+                        seen.add(other)
+                        todo.append(other)
+            self.predictions[name] = functools.reduce(operator.or_, (self.skip(self.initial.get(other, 0)) for other in seen), 0)
+
+    @classmethod
+    def get(cls, rules: Dict[int, Rule], start: str) -> 'Recognizer':
+        """The recognizer for the rules by id, made once for all parsers of the same grammar"""
+        key = (tuple(sorted(rules)), start)
+        if key not in cls.cache:
+            cls.cache[key] = cls(rules, start)
+        return cls.cache[key]
+
+    def skip(self, items: int) -> int:
+        """The dotted rules, plus those with the dot moved past nullable names"""
+        while True:
+            skipped = items | (items & self.nullable) << 1
+            if skipped == items:
+                return items
+            items = skipped
+
+    def expected(self, items: int) -> Set[str]:
+        """The non-terminals the dotted rules expect"""
+        return {name for name, mask in self.expects.items() if items & mask}
+
+    def add(self, column: Dict[int, int], origin: int, items: int) -> bool:
+        """Adds the dotted rules to the column, and whether that added any"""
+        before = column.get(origin, 0)
+        column[origin] = before | self.skip(items)
+        return column[origin] != before
+
+    def close(self, table: List[Dict[int, int]], position: int) -> None:
+        """Completes and predicts in the last column until nothing changes"""
+        column = table[position]
+        completed = defaultdict(int)  # type: Dict[int, int]
+        predicted = set()  # type: Set[str]
+        changed = True
+        while changed:
+            changed = False
+            # Rules that span nothing are never completed, skip() already
+            # moved the dot past their names.
+            for origin in sorted(column, reverse=True):
+                done = column[origin] & self.final & ~completed[origin]
+                if origin == position or not done:
+                    continue
+                completed[origin] |= done
+                names = set()
+                while done:
+                    bit = done & -done
+                    names.add(self.lhs[bit.bit_length() - 1])
+                    done ^= bit
+                for name in names:
+                    mask = self.expects.get(name, 0)
+                    for previous, items in list(table[origin].items()):
+                        if items & mask:
+                            changed = self.add(column, previous, (items & mask) << 1) or changed
+            for name in self.expected(functools.reduce(operator.or_, column.values(), 0)) - predicted:
+                predicted.add(name)
+                # Names with only empty rules predict nothing
+                changed = self.add(column, position, self.predictions.get(name, 0)) or changed
+
+    def recognize(self, tokens: Sequence[Any]) -> Tuple[bool, int]:
+        """
+        Whether the tokens are a sentence of the start name, and how many of
+        them could be read: the position of the first token that does not
+        fit in anywhere, or else len(tokens).
+        """
+        table = [{0: self.predictions.get(self.start, 0)}]
+        self.close(table, 0)
+        for position, token in enumerate(tokens):
+            items = functools.reduce(operator.or_, table[position].values(), 0)
+            accepted = self.literals.get(token, 0) if isinstance(token, str) else 0
+            for symbol, mask in self.terminals.values():
+                if items & mask and symbol.test(token, position, None):
+                    accepted |= mask
+            column = dict()  # type: Dict[int, int]
+            for origin, items in table[position].items():
+                if items & accepted:
+                    self.add(column, origin, (items & accepted) << 1)
+            if not column:
+                return False, position
+            table.append(column)
+            self.close(table, position + 1)
+        return table[-1].get(0, 0) & self.finished.get(self.start, 0) != 0, len(tokens)
 
 
 class Parser:
+    # Returned by a callback to reject the derivation, see Continue
     FAIL = {}  # type: Any
 
-    def __init__(self, rules: List[Rule], start: str) -> None:
+    # Deduplication policies: keep every distinct derivation of an item (and
+    # with it every possible parse), or keep only the first derivation of it.
+    DERIVATIONS = 'derivations'
+    MERGE = 'merge'
+
+    def __init__(self, rules: List[Rule], start: str, dedupe: str = DERIVATIONS, tracing: str = Trace.COMPACT, forest: bool = False, leo: bool = True, incremental: bool = True,
+                 limit: Optional[int] = None, beam: Optional[int] = None, score: Optional[Callable[[Optional[State], Any], Any]] = None,
+                 distinct: Optional[Callable[[Any], Any]] = None, precheck: bool = False, statistics: Optional[Statistics] = None,
+                 compiled: Optional[Any] = None) -> None:
+        """
+        In forest mode the chart is a shared packed parse forest: the parser
+        only recognizes, and the callbacks run when the derivations are
+        enumerated using derivations() or finish(). The dedupe and tracing
+        options do not apply then, but Leo's shortcut for right recursion
+        (see LeoItem) does.
+
+        With incremental off, results is not brought up to date after every
+        feed(), only by parse() and reparse_from(); call finish() for the
+        results after feeding yourself.
+
+        score(state, data) ranks results (and states, for the beam) like a sort
+        key: the lowest score comes first. With a limit, only that many results
+        are kept, see finish(). With a beam, only that many of the partially
+        matched states in each column are advanced any further. Without a
+        score, the first ones found are kept. In forest mode states have no
+        data yet, so there the beam ignores the score.
+
+        distinct(data) gives a hashable key for the data of a result: of the
+        results with the same key only the first is kept, before the limit.
+
+        With precheck on, parse() first runs the input through a Recognizer,
+        and only parses it when it is in the language.
+
+        Given a Statistics (see instrumentation), the parser counts per rule
+        how often it was predicted, completed and rejected, and the time its
+        callback took, and records the size of the chart for each parse.
+
+        Given the CompiledGrammar the rules came from (see compiled.py), the
+        parser takes the nullable non-terminals from its tables, and predicts
+        all the non-terminals that predicting one leads to at once.
+        """
         self.rules = rules
         self.start = start
-        self.table = []  # type: List[List[State]] (first index is token, second index is possible state)
+        self.forest = forest
+        self.leo = leo
+        self.incremental = incremental
+        self.limit = limit
+        self.beam = beam
+        self.score = score
+        self.distinct = distinct
+        self.precheck = precheck
+        self.statistics = statistics
+
+        if tracing not in (Trace.OFF, Trace.COMPACT, Trace.FULL):
+            raise ValueError('Unknown tracing mode {!r}'.format(tracing))
+        self.tracing = tracing
+
+        if forest:
+            self.key = operator.attrgetter('item')
+            self.tracing = Trace.OFF
+        elif dedupe == self.DERIVATIONS:
+            self.key = operator.attrgetter('derivation')
+        elif dedupe == self.MERGE:
+            self.key = operator.attrgetter('item')
+        else:
+            raise ValueError('Unknown dedupe policy {!r}'.format(dedupe))
+
+        # Index the rules by name once, so predicting a non-terminal does not
+        # have to walk past every rule in the grammar. A rule that is in the
+        # grammar twice (see Rule.signature) would derive the same parses
+        # twice, so only the first of those counts. Empty rules are never
+        # predicted, see empties().
+        self.index = defaultdict(list)  # type: Dict[str, List[Rule]]
+        self.byId = dict()  # type: Dict[int, Rule]
+        signatures = set()
+        for rule in rules:
+            if rule.signature not in signatures:
+                signatures.add(rule.signature)
+                self.byId[rule.id] = rule
+                if len(rule.symbols) > 0:
+                    self.index[rule.name].append(rule)
+
+        # Non-terminals that can derive nothing at all
+        self.nullable = set()  # type: Set[str]
+        if compiled is not None:
+            self.nullable = {name for name, nullable in zip(compiled.names, compiled.nullable) if nullable}
+        changed = compiled is None
+        while changed:
+            changed = False
+            for rule in self.byId.values():
+                if rule.name not in self.nullable \
+                        and all(isinstance(symbol, RuleRef) and symbol.name in self.nullable for symbol in rule.symbols):
+                    self.nullable.add(rule.name)
+                    changed = True
+        self._empties = dict()  # type: Dict[str, List[EmptyDerivation]]
+
+        # The names predicting a name predicts along, itself first. Without
+        # a compiled grammar that is just the name: the others are predicted
+        # one by one as the states of the column are processed.
+        self.predictions = dict()  # type: Dict[str, List[str]]
+        if compiled is not None:
+            for code, name in enumerate(compiled.names):
+                self.predictions[name] = list(dict.fromkeys([name] + [compiled.names[compiled.productions[n][0]] for n in compiled.predictions[code]]))
+
+        self.table = []  # type: List[Column] (first index is token, second index is possible state)
+        self.tokens = []  # type: List[Any]
         self.results = []  # type: List[Any]
+        self.rejections = 0  # Derivations that callbacks returned FAIL for
+        self.found = 0
         self.current = 0
         self.reset()
 
@@ -368,87 +1197,316 @@ class Parser:
     def reset(self) -> None:
         # Clear previous work
         self.results = []
+        self.rejections = 0
+        self.tokens = []
         self.current = 0
 
         # Setup a table
-        added_rules = []
-        self.table = [[]]
+        self.table = [Column(self.byId, self.key, pack=self.forest)]
 
         # Prepare the table with all rules that match the start name
-        for rule in self.rules:
-            if rule.name == self.start:
-                added_rules.append(rule)
-                self.table[0].append(State(rule, 0, 0))
-        self.advanceTo(0, added_rules)
-
-    def advanceTo(self, position: int, added_rules: List[Rule]) -> None:
+        self.predictName(self.table[0], self.start, 0)
+        self.advanceTo(0)
+
+    def leoItem(self, position: int, name: str) -> Optional[LeoItem]:
+        """The Leo item for completing `name` in a column the parser is done with, if there is one"""
+        column = self.table[position]
+        if name not in column.leo:
+            column.leo[name] = None  # Also stops unit rules that cycle
+            waiting = column.waiting.get(name, ())
+            if len(waiting) == 1:
+                state = column.state(waiting[0])
+                # The complete states in between are never added to the chart,
+                # so none of them can be a result.
+                if state.expect == len(state.rule.symbols) - 1 \
+                        and not (state.rule.name == self.start and state.reference == 0):
+                    column.leo[name] = LeoItem(state, self.leoItem(state.reference, state.rule.name))
+        return column.leo[name]
+
+    def advanceTo(self, position: int) -> None:
+        column = self.table[position]
         w = 0
-        while w < len(self.table[position]):
-            try:
-                self.table[position][w].process(position, self.table, self.rules, added_rules)
-            except Continue:
-                pass
+        while w < len(column):
+            if column.dots[w] == len(column.rule(w).symbols):
+                column.state(w).complete(position, self.table, self)
+            else:
+                self.predict(position, column, w)
             w += 1
 
+    def reject(self, column: Column, state: State) -> None:
+        """Drops a state whose callback returned FAIL"""
+        self.rejected(state.rule)
+        # Let another derivation of the same item take its place
+        column.keys.pop(column.key(state), None)
+
+    def rejected(self, rule: Rule) -> None:
+        self.rejections += 1
+        if self.statistics is not None:
+            self.statistics[rule].rejections += 1
+
+    def empties(self, name: str, visiting: FrozenSet[str] = frozenset()) -> List[EmptyDerivation]:
+        """
+        All the ways in which a non-terminal can derive nothing. Derivations
+        that go round in circles, back to a name in visiting, do not count.
+        Which ones those are depends on visiting, so only the derivations of
+        a name by itself are remembered.
+        """
+        if name in visiting:
+            return []
+        if not visiting and name in self._empties:
+            return self._empties[name]
+        empties = []
+        for rule in self.byId.values():
+            if rule.name == name and all(isinstance(symbol, RuleRef) and symbol.name in self.nullable for symbol in rule.symbols):
+                for children in itertools.product(*(self.empties(symbol.name, visiting | {name}) for symbol in rule.symbols)):
+                    empties.append(EmptyDerivation(rule, list(children)))
+        if not visiting:
+            self._empties[name] = empties
+        return empties
+
+    def predictName(self, column: Column, name: str, location: int) -> None:
+        """Predicts the rules of a name, and of the names it predicts along (see predictions), that the column did not predict yet"""
+        for other in self.predictions.get(name, (name,)):
+            if other not in column.predicted:
+                column.predicted.add(other)
+                for rule in self.index[other]:
+                    column.predict(rule, location)
+                if self.statistics is not None:
+                    for rule in self.index[other]:
+                        self.statistics[rule].predictions += 1
+
+    def predict(self, location: int, column: Column, index: int) -> None:
+        # I'm not done, but I can predict something
+        expected_symbol = column.rule(index).symbols[column.dots[index]]
+
+        if isinstance(expected_symbol, RuleRef):
+            # Make a note that you've added it already, and don't need to
+            # add it again; otherwise left recursive rules are going to go
+            # into an infinite loop by adding themselves over and over
+            # again.
+            self.predictName(column, expected_symbol.name, location)
+
+            # If the non-terminal can derive nothing, it can also be skipped
+            # right away (Aycock & Horspool). Completing a state that spans
+            # nothing would come too late for the states that were already
+            # processed, so that is not what we rely on.
+            if expected_symbol.name in self.nullable:
+                state = column.state(index)
+                for empty in self.empties(expected_symbol.name):
+                    if self.forest:
+                        column.add(state.advance(empty))
+                        continue
+                    data = empty.data
+                    if data is self.FAIL:
+                        self.rejected(empty.rule)
+                        continue
+                    copy = state.nextState(None, data, Trace.record(self.tracing, Trace.NON_TERMINAL, state.rule, state.expect, empty.rule))
+                    copy.child = empty
+                    column.add(copy)
+
     def feed(self, chunk) -> None:
         for token_pos, token in enumerate(chunk):
+            # Positions are counted from the start of the input, not the chunk
+            position = self.current
+
             # We add anew states to table[current + 1]
-            self.table.append([])
+            self.table.append(Column(self.byId, self.key, pack=self.forest))
+            self.tokens.append(token)
 
             # Advance all tokens that expect the symbol
-            # So for each state in the previous row,
-
-            w = 0
-            while w < len(self.table[self.current + token_pos]):
-                current_state = self.table[self.current + token_pos][w]
-                next_state = current_state.consumeTerminal(token, token_pos)
-                if next_state is not None:
-                    self.table[self.current + token_pos + 1].append(next_state)
-                w += 1
+            # So for each state in the previous row, (duplicates are dropped
+            # by the column as they are added)
 
-            # Are there duplicates?
-            t = self.table[self.current + token_pos + 1] 
-            for i, left in enumerate(t):
-                for right in t[i+1:]:
-                    if left == right:
-                        t[i] = None
-                        break
-            self.table[self.current + token_pos + 1] = list(filter(lambda s: s is not None, t))
+            for current_state in self.table[position].scan(token, position):
+                if self.forest:
+                    self.table[position + 1].add(current_state.advance(position))
+                else:
+                    self.table[position + 1].add(current_state.scan(token, position, self.tracing))
 
             # Next, for each of the rules, we either
             # (a) complete it, and try to see if the reference row expected that rule
             # (b) predict the next nonterminal it expects by adding that nonterminal's stat state
-            # To prevent duplication, we also keep track of rules we have already added.
+            # To prevent duplication, the column keeps track of names it already predicted.
+            self.advanceTo(position + 1)
 
-            added_rules = []  # type: List[Rule]
-            self.advanceTo(self.current + token_pos + 1, added_rules)
+            if self.beam is not None:
+                self.prune(self.table[position + 1])
 
             # If needed, throw an error
             if len(self.table[-1]) == 0:
                 # No states at all! This is not good
                 # print(self.table)
-                raise ParseError(self.current + token_pos, token, sentence=chunk,
+                error = ParseError(position, token, sentence=self.tokens + list(chunk[token_pos + 1:]),
                     expected=[str(state.rule.symbols[state.expect] \
                         if len(state.rule.symbols) < state.expect \
                         else "{}".format(state.rule)) for state in self.table[-2]])
+                # Forget the token, so the parser can go on from the tokens before it
+                self.rollback(position)
+                raise error
+
+            self.current += 1
+
+        if self.incremental:
+            self.track()
+
+    def prune(self, column: Column) -> None:
+        """Keeps the best `beam` of the partially matched states in a column the parser is done with"""
+        candidates = sorted(index for index, state in column.states.items()
+                            if 0 < column.dots[index] < len(state.rule.symbols))
+        if len(candidates) <= self.beam:
+            return
+        if self.score is None or self.forest:
+            kept = candidates[:self.beam]
+        else:
+            kept = heapq.nsmallest(self.beam, candidates, key=lambda index: self.score(column.states[index], column.states[index].data))
+        column.discard(set(candidates).difference(kept))
+
+    def track(self) -> None:
+        # Keep track of results (in forest mode that would run all callbacks,
+        # so that waits until someone asks.)
+        if not self.forest:
+            self.results = self.finish()
+
+    def measure(self) -> None:
+        if self.statistics is not None:
+            self.statistics.parsed(tokens=len(self.tokens), items=sum(len(column) for column in self.table),
+                                   largest_column=max(len(column) for column in self.table))
+
+    def rollback(self, position: int) -> None:
+        """
+        Forget the input after the first `position` tokens, as if only those
+        were fed. A column of the chart does not change anymore once the
+        parser has moved past it, so the chart up to there is kept as is.
+        """
+        if not 0 <= position <= len(self.tokens):
+            raise ValueError('Cannot roll back to position {} of {} tokens'.format(position, len(self.tokens)))
+        del self.table[position + 1:]
+        del self.tokens[position:]
+        self.current = position
+        if self.incremental:
+            self.track()
+
+    def reparse_from(self, position: int, tokens: List[Any]) -> List[Any]:
+        """
+        Replaces the input from `position` on with `tokens` and returns the
+        new results. Only the tokens after the longest unchanged prefix are
+        parsed again.
+        """
+        if not 0 <= position <= len(self.tokens):
+            raise ValueError('Cannot reparse from position {} of {} tokens'.format(position, len(self.tokens)))
+
+        unchanged = position
+        while unchanged < len(self.tokens) \
+                and unchanged - position < len(tokens) \
+                and self.tokens[unchanged] == tokens[unchanged - position]:
+            unchanged += 1
+
+        del self.table[unchanged + 1:]
+        del self.tokens[unchanged:]
+        self.current = unchanged
+        self.feed(tokens[unchanged - position:])
+        if not self.incremental:
+            self.track()
+        self.measure()
+        return self.results if not self.forest else self.finish()
+
+    def derivations(self, limit: Optional[int] = None) -> List[dict]:
+        """The results of the first `limit` derivations in forest mode, running only the callbacks needed for those"""
+        assert self.forest, "derivations() needs a parser in forest mode"
+        return list(itertools.islice(Forest(self).results(), limit))
+
+    def count(self) -> int:
+        """The number of derivations in forest mode, without running any callbacks"""
+        assert self.forest, "count() needs a parser in forest mode"
+        return Forest(self).count()
+
+    def finish(self) -> List[Result]:
+        """
+        The results, best first if there is a score. With a limit only the
+        best `limit` results are returned, and found is how many (distinct)
+        results there were. In forest mode without a score the callbacks only
+        run until there are `limit` results, and the others are not counted;
+        ranking the derivations needs all of them.
+        """
+        if self.forest:
+            results = self.unique(Forest(self).results(), lambda result: result['data'])
+            if self.score is None:
+                results = list(itertools.islice(results, self.limit))
+                self.found = len(results)
+                return results
+            results = list(results)
+            self.found = len(results)
+            return self.best(results, lambda result: self.score(None, result['data']))
 
-        self.current += len(chunk)
-
-        # Incrementally keep track of results
-        self.results = self.finish()
-
-    def finish(self) -> List[List[Any]]:
         # Return the possible parsings
-        return [dict(data=state.data, trace=list(reversed(state.trace)), tree=state.tree) for state in self.table[-1] if
-                state.rule.name == self.start
-                and state.expect == len(state.rule.symbols)
-                and state.reference == 0
-                and state.data is not self.FAIL]
+        completed = list(self.unique((state for state in self.table[-1].completed() if
+                                      state.rule.name == self.start
+                                      and state.reference == 0
+                                      and state.data is not self.FAIL), lambda state: state.data))
+        self.found = len(completed)
+        return [Result(state.data, lambda state=state: state.trace.render() if state.trace is not None else [], lambda state=state: state.tree)
+                for state in self.best(completed, lambda state: self.score(state, state.data))]
+
+    def unique(self, results: Iterable[Any], data: Callable[[Any], Any]) -> Iterator[Any]:
+        """The results, but only the first of those whose data has the same distinct() key"""
+        if self.distinct is None:
+            yield from results
+            return
+        seen = set()  # type: Set[Any]
+        for result in results:
+            key = self.distinct(data(result))
+            if key not in seen:
+                seen.add(key)
+                yield result
+
+    def best(self, results: List[Any], key: Callable[[Any], Any]) -> List[Any]:
+        if self.score is None:
+            return results[:self.limit]
+        if self.limit is None:
+            return sorted(results, key=key)
+        return heapq.nsmallest(self.limit, results, key=key)
+
+    def expected(self) -> List[Symbol]:
+        """
+        The terminals the next token can match, one per literal or symbol key,
+        in the order the states expecting them were added. The last column
+        already groups its states that way, so this costs nothing like a parse.
+        """
+        column = self.table[-1]
+        groups = [indices for indices in column.literals.values() if len(indices) > 0]
+        groups.extend(indices for _, indices in column.terminals.values())
+        return [column.rule(indices[0]).symbols[column.dots[indices[0]]] for indices in sorted(groups, key=lambda indices: indices[0])]
+
+    def recognize(self, tokens: Sequence[Any]) -> Tuple[bool, int]:
+        """See Recognizer.recognize"""
+        return Recognizer.get(self.byId, self.start).recognize(tokens)
+
+    def explain(self, chunk: List[Any]) -> Optional[List[str]]:
+        """
+        What was expected instead of the last token, as a ParseError lists
+        it, found in forest mode so no callbacks run.
+        """
+        try:
+            Parser(self.rules, self.start, forest=True, leo=self.leo).feed(chunk)
+        except ParseError as error:
+            return error.expected
+        return None
 
     def parse(self, chunk: List[str]) -> List[State]:
+        if self.precheck:
+            accepted, position = self.recognize(chunk)
+            if position < len(chunk):
+                self.reset()
+                raise ParseError(position, chunk[position], sentence=list(chunk), expected=self.explain(chunk[:position + 1]))
+            if not accepted:
+                self.reset()
+                return []
         self.reset()
         self.feed(chunk)
-        return self.results
+        if not self.incremental:
+            self.track()
+        self.measure()
+        return self.results if not self.forest else self.finish()
 
 
 def tokenize(sentence: str) -> List[str]:
@@ -505,6 +1563,8 @@ def read_sentences_txt(fh):
             if section not in sections:
                 sections[section] = list()
         elif len(line.strip()) > 0:
+            if section not in sections:  # Sentences before the first heading
+                sections[section] = list()
             sections[section].append(line.strip())
 
     return sections
@@ -532,6 +1592,7 @@ def read_sentences_tex(fh):
 if __name__ == '__main__':
     import traceback
     import sys
+    from random import Random
 
     # Test simple literals
     # p = Parser([Rule('START', [Literal('a'), Literal('b'), Literal('c')])], 'START')
@@ -564,6 +1625,48 @@ if __name__ == '__main__':
         print(p.parse(list('AAAA')))
 
 
+    def test_leo():
+        """Test that Leo's shortcut for right recursion finds the same derivations as without it"""
+        def same(rules, start, tokens):
+            try:
+                results = {leo: Parser(rules, start, forest=True, leo=leo) for leo in (False, True)}
+                derivations = {leo: sorted(repr(result['data']) for result in p.parse(tokens)) for leo, p in results.items()}
+            except ParseError:
+                return False
+            assert derivations[True] == derivations[False], tokens
+            assert results[True].count() == results[False].count() == len(derivations[True]), tokens
+            return len(derivations[True]) > 0
+
+        right = [
+            Rule('A', [Literal('a'), RuleRef('A')]),
+            Rule('A', [Literal('a')]),
+        ]
+        ambiguous = [
+            Rule('A', [RuleRef('B'), RuleRef('A')]),
+            Rule('A', [Literal('a')]),
+            Rule('B', [Literal('a')]),
+            Rule('B', [Literal('a'), Literal('a')]),
+        ]
+        nullable = [
+            Rule('A', [Literal('a'), RuleRef('A'), RuleRef('OPT')]),
+            Rule('A', [Literal('a')]),
+            Rule('OPT', []),
+        ]
+        for rules in (right, ambiguous, nullable):
+            for length in range(1, 8):
+                assert same(rules, 'A', ['a'] * length)
+
+        # Without empty or unit rules there are only so many derivations
+        random = Random(7)
+        names = ['START', 'A', 'B']
+        for _ in range(1000):
+            rules = [Rule(random.choice(names), [RuleRef(random.choice(names)) if random.random() < 0.4 else Literal(random.choice('ab'))
+                                                 for _ in range(random.randrange(1, 4))])
+                     for _ in range(random.randrange(1, 7))]
+            rules = [rule for rule in rules if not (len(rule.symbols) == 1 and isinstance(rule.symbols[0], RuleRef))]
+            for _ in range(4):
+                same(rules, 'START', [random.choice('ab') for _ in range(random.randrange(1, 7))])
+
     def test_nested_left_recursion():
         """Test nested left recursion"""
         p = Parser([
@@ -591,6 +1694,233 @@ if __name__ == '__main__':
         ], 'START')
         print(p.parse(list('AAABBB')))
 
+    def test_nullable():
+        """Test a non-terminal that only derives nothing through another one"""
+        rules = [
+            Rule('START', [RuleRef('OPT'), Literal('A'), RuleRef('OPT')]),
+            Rule('OPT', [RuleRef('EMPTY')]),
+            Rule('OPT', [Literal('B')]),
+            Rule('EMPTY', []),
+        ]
+        for tokens in ('A', 'BA', 'BAB'):
+            results = Parser(rules, 'START').parse(list(tokens))
+            assert len(results) == 1
+            print(results[0]['data'])
+        assert Parser(rules, 'START', forest=True).parse(list('AB'))[0]['tree'] == Parser(rules, 'START').parse(list('AB'))[0]['tree']
+        # Deriving nothing in a circle, through names that are nullable on their own too
+        cycle = [
+            Rule('START', [RuleRef('X'), Literal('x'), RuleRef('Y')]),
+            Rule('X', []),
+            Rule('X', [RuleRef('Y')]),
+            Rule('Y', [RuleRef('X')]),
+            Rule('Y', [Literal('y')]),
+        ]
+        assert Parser(cycle, 'START').recognize(['x']) == (True, 1)
+        assert len(Parser(cycle, 'START').parse(['x'])) == 1
+        assert len(Parser(cycle, 'START', forest=True).parse(['x'])) == 1
+
+    def test_reparse():
+        """Test reparsing after changing the input halfway"""
+        rules = [
+            Rule('A', [RuleRef('A'), Alpha()]),
+            Rule('A', [RuleRef('A'), Digit()]),
+            Rule('A', [Literal('A')]),
+        ]
+        p = Parser(rules, 'A')
+        p.parse(list('AB2D'))
+        results = p.reparse_from(2, list('CD5'))
+        assert p.tokens == list('ABCD5')
+        assert [repr(result['data']) for result in results] == [repr(result['data']) for result in Parser(rules, 'A').parse(list('ABCD5'))]
+        # A token that does not fit in leaves the parser as it was before it
+        try:
+            p.feed(list('E?'))
+            assert False, 'no error'
+        except ParseError as error:
+            assert error.position == 6
+        assert p.tokens == list('ABCD5E') and len(p.table) == 7
+        results = p.reparse_from(6, list('F'))
+        assert [repr(result['data']) for result in results] == [repr(result['data']) for result in Parser(rules, 'A').parse(list('ABCD5EF'))]
+        print(results)
+
+    def test_result():
+        """Test that trees are only made when asked for, and that results still act like dicts"""
+        import json
+        rules = [
+            Rule('A', [RuleRef('A'), Alpha()], lambda state, data: data[0] + data[1]),
+            Rule('A', [Literal('A')], lambda state, data: data[0]),
+        ]
+        p = Parser(rules, 'A', incremental=False)
+        p.feed(list('AB'))
+        assert p.results == []
+        result, = p.finish()
+        assert 'tree' in result and 'tree' not in dict.keys(result)
+        assert result['tree']['label'] == 'A' and 'tree' in dict.keys(result)
+        assert json.loads(json.dumps(result)).keys() == {'data', 'trace', 'tree'}
+        assert result == Parser(rules, 'A').parse(list('AB'))[0]
+        print(result)
+
+    def test_limit():
+        """Test keeping only the best parses, and pruning the chart with a beam"""
+        rules = [
+            Rule('A', [RuleRef('A'), RuleRef('A')], lambda state, data: '({}{})'.format(*data)),
+            Rule('A', [Alpha()], lambda state, data: data[0]),
+        ]
+        def depth(state, data):
+            return max(itertools.accumulate(1 if c == '(' else -1 if c == ')' else 0 for c in data)) if isinstance(data, str) else 0
+        everything = Parser(rules, 'A').parse(list('abcd'))
+        assert len(everything) == 5
+        best = Parser(rules, 'A', limit=2, score=depth)
+        assert [result['data'] for result in best.parse(list('abcd'))] == ['((ab)(cd))', '(((ab)c)d)']
+        assert best.found == 5
+        forest = Parser(rules, 'A', forest=True, limit=2)
+        assert len(forest.parse(list('abcd'))) == 2
+        assert len(Parser(rules, 'A', beam=1).parse(list('abcd'))) < 5
+        # Derivations with the same data count once, before the limit cuts them off
+        flat = [
+            Rule('A', [RuleRef('A'), RuleRef('A')], lambda state, data: data[0] + data[1]),
+            Rule('A', [Alpha()], lambda state, data: data[0]),
+            Rule('B', [RuleRef('A')], lambda state, data: 'A:' + data[0]),
+            Rule('B', [Alpha(), RuleRef('A')], lambda state, data: 'a:' + data[0] + data[1]),
+        ]
+        for forest in (False, True):
+            distinct = Parser(flat, 'B', forest=forest, limit=2, distinct=lambda data: data)
+            assert sorted(result['data'] for result in distinct.parse(list('abcd'))) == ['A:abcd', 'a:abcd']
+            assert distinct.found == 2
+        print([result['data'] for result in best.results])
+
+    def test_expected():
+        """Test which terminals can come next after a prefix"""
+        rules = [
+            Rule('START', [RuleRef('OPT'), Literal('A'), RuleRef('LIST')]),
+            Rule('OPT', []),
+            Rule('OPT', [Literal('B')]),
+            Rule('LIST', [RuleRef('LIST'), Digit()]),
+            Rule('LIST', [Digit()]),
+        ]
+        p = Parser(rules, 'START', forest=True)
+        assert [repr(symbol) for symbol in p.expected()] == ['"B"', '"A"']
+        p.feed(list('BA'))
+        assert [type(symbol) for symbol in p.expected()] == [Digit]
+        p.feed(list('1'))
+        assert len(p.expected()) == 1
+        print(p.expected())
+
+    def test_recognize():
+        """Test recognizing without parsing, also with empty rules"""
+        rules = [
+            Rule('START', [RuleRef('OPT'), Literal('A'), RuleRef('LIST')]),
+            Rule('OPT', []),
+            Rule('OPT', [Literal('B')]),
+            Rule('LIST', [RuleRef('LIST'), Digit()]),
+            Rule('LIST', [RuleRef('OPT')]),
+        ]
+        p = Parser(rules, 'START', precheck=True)
+        for tokens in (list('A'), list('BA'), list('A12'), list('BAB12'), list('AB'), list('BB'), list('A1B'), list('B')):
+            accepted, position = p.recognize(tokens)
+            try:
+                results = Parser(rules, 'START').parse(tokens)
+                assert accepted == (len(results) > 0) and position == len(tokens), tokens
+            except ParseError as error:
+                assert not accepted and position == error.position, tokens
+        assert p.recognize(list('A1B')) == (False, 2)
+        assert p.parse(list('B')) == []
+
+        # Input that is rejected runs no callbacks, also when a token does not fit in
+        calls = []
+        def count(state, data):
+            calls.append(data)
+            return data
+        ambiguous = [
+            Rule('S', [RuleRef('S'), RuleRef('S')], count),
+            Rule('S', [Literal('a')], count),
+        ]
+        try:
+            Parser(ambiguous, 'S', precheck=True).parse(list('aaaaaaab'))
+            assert False, 'no error'
+        except ParseError as error:
+            assert error.position == 7 and error.expected is not None
+        assert len(calls) == 0
+        try:
+            Parser(ambiguous, 'S').parse(list('aaaaaaab'))
+        except ParseError:
+            assert len(calls) > 0
+        print(p.recognize(list('BAB12')))
+
+    def test_recognize_empty():
+        """Test recognizing with names that only have empty rules, also against the parser for random grammars"""
+        def same(rules, tokens):
+            accepted, position = Parser(rules, 'START').recognize(tokens)
+            try:
+                results = Parser(rules, 'START', dedupe=Parser.MERGE).parse(tokens)
+                assert accepted == (len(results) > 0) and position == len(tokens), tokens
+            except ParseError as error:
+                assert not accepted and position == error.position, tokens
+
+        epsilon = [
+            Rule('START', [RuleRef('NONE'), Literal('a'), RuleRef('NONE')]),
+            Rule('NONE', []),
+        ]
+        chain = [
+            Rule('START', [RuleRef('A'), Literal('a'), RuleRef('B')]),
+            Rule('A', [RuleRef('B')]),
+            Rule('B', [RuleRef('C')]),
+            Rule('C', []),
+        ]
+        for rules in (epsilon, chain):
+            for tokens in ([], ['a'], ['a', 'a'], ['b']):
+                same(rules, tokens)
+            assert len(Parser(rules, 'START', precheck=True).parse(['a'])) == 1
+
+        # The precheck fails the same way as parsing without one
+        try:
+            Parser(chain, 'START', precheck=True).parse(['a', 'b'])
+            assert False, 'no error'
+        except ParseError as error:
+            try:
+                Parser(chain, 'START').parse(['a', 'b'])
+            except ParseError as expected:
+                assert str(error) == str(expected) and 'expected' in str(error)
+
+        random = Random(1)
+        names = ['START', 'A', 'B']
+        for _ in range(200):
+            rules = [Rule(random.choice(names), [RuleRef(random.choice(names)) if random.random() < 0.5 else Literal(random.choice('ab'))
+                                                 for _ in range(random.randrange(3))])
+                     for _ in range(random.randrange(1, 6))]
+            for _ in range(5):
+                same(rules, [random.choice('ab') for _ in range(random.randrange(4))])
+
+    def test_distinct_rules():
+        """Test that rules that look the same but are not stay apart"""
+        rules = [
+            Rule('START', [Literal('a')], lambda state, data: 'one'),
+            Rule('START', [Literal('a')], lambda state, data: 'two'),
+        ]
+        assert sorted(result['data'] for result in Parser(rules, 'START').parse(['a'])) == ['one', 'two']
+
+        class Word(Symbol):
+            def __init__(self, exclude):
+                self.exclude = exclude
+
+            def __repr__(self):
+                return '<word>'
+
+            @property
+            def key(self):
+                return (type(self), self.exclude)
+
+            def test(self, literal, position, state):
+                return literal != self.exclude
+
+        rules = [
+            Rule('START', [Word('a')]),
+            Rule('START', [Word('b')]),
+        ]
+        for precheck in (False, True):
+            assert len(Parser(rules, 'START', precheck=precheck).parse(['a'])) == 1
+            assert len(Parser(rules, 'START', precheck=precheck).parse(['c'])) == 2
+        print(Parser(rules, 'START').parse(['a']))
+
     if len(sys.argv) > 1:
         tests = [globals()[arg] for arg in sys.argv[1:]]
     else: